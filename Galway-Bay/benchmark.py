@@ -0,0 +1,138 @@
+''' Benchmark of the forecast pipeline on synthetic ROMS datasets (see
+    synthetic.py). For each scale, a synthetic dataset is written and each
+    stage of the pipeline is timed, with its peak memory (NumPy and Python
+    allocations, as traced by tracemalloc). Each scale runs in a new process,
+    so that the peak resident memory (RSS) of each scale is also reported:
+
+        python benchmark.py small medium --surge 1.5 --json benchmark.json '''
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from time import perf_counter
+import tempfile
+import tracemalloc
+import argparse
+import resource
+import json
+
+# Scales: grid size (M x L), hourly time steps and number of sites
+SCALES = dict(
+    small =dict(M=50,  L=100, T=72,  sites=4),
+    medium=dict(M=100, L=200, T=96,  sites=16),
+    large =dict(M=200, L=400, T=120, sites=64),
+    coast =dict(M=200, L=400, T=120, sites=256),
+)
+
+@contextmanager
+def stage(results, name):
+    ''' Time a stage and trace its peak memory '''
+
+    tracemalloc.start()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(dict(stage=name, time=elapsed, peak=peak / 2**20))
+
+def run(scale, surge=0.0, layers=8):
+    ''' Run the benchmark at one scale. Return the timings of each stage '''
+
+    # Import here, so that the cost of importing is not carried over between
+    # scales and the logger is set up in the worker process
+    import numpy as np
+    import synthetic
+    import galway
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        with stage(results, 'synthetic dataset'):
+            model = synthetic.make(f'{tmp}/synthetic.nc', layers=layers, surge=surge,
+                                   **SCALES[scale])
+
+        config = dict(timezone='Europe/Dublin', snapshot=f'{tmp}/snapshot')
+        UTC = galway.get_UTC_time(config['timezone'], minute=True)
+        NOW = int(UTC.timestamp())
+
+        nc = galway.dataset(model)
+        state = galway.STATE[model['name']]
+
+        with stage(results, 'site_index'):
+            state['index'], state['checked'] = galway.site_index(nc, model), nc
+
+        with stage(results, 'site_reader'):
+            time, series = galway.site_reader(nc, model, NOW)
+
+        with stage(results, 'reader (whole grid)'):
+            galway.reader(nc, model)
+
+        with stage(results, 'stream_reader'):
+            galway.stream_reader(nc, model)
+
+        with stage(results, 'tidal_spline'):
+            F = galway.tidal_spline(time, series['tideS'])
+
+        with stage(results, 'minute_interpolation'):
+            time_minfeq, tides = galway.minute_interpolation(F)
+
+        with stage(results, 'tide_table'):
+            table = galway.tide_table(F)
+
+        with stage(results, 'tidal_times'):
+            for k in range(len(model['names'])):
+                a, b = np.searchsorted(table['site'], [k, k + 1])
+                future = table['time'][a:b] > NOW
+                galway.tidal_times(table['time'][a:b][future], table['level'][a:b][future],
+                                   table['type'][a:b][future])
+
+        state['forecast'] = dict(time=time, series=series, F=F, table=table,
+            arrays=dict(time=time_minfeq, tide=tides.astype(np.float32)), 
+            missing=np.zeros(len(model['names']), dtype=bool), published=False)
+
+        with stage(results, 'publish (site loop)'):
+            galway.publish(config, model, UTC)
+
+        with stage(results, 'publish (now tick)'):
+            galway.publish(config, model, UTC)
+
+        galway.close(model)
+
+    # Peak resident memory of this process [MB]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    return dict(scale=scale, **SCALES[scale], surge=surge, rss=rss, stages=results)
+
+def report(result):
+    ''' Print the timings of one scale as a table '''
+
+    print(f"\n{result['scale']}: {result['M']} x {result['L']} grid, {result['T']} time steps, "
+          f"{result['sites']} sites, surge {result['surge']} m, peak RSS {result['rss']:.1f} MB")
+    print(f"{'stage':<24}{'time [s]':>12}{'peak [MB]':>12}")
+    for row in result['stages']:
+        print(f"{row['stage']:<24}{row['time']:>12.4f}{row['peak']:>12.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the forecast pipeline')
+    parser.add_argument('scales', nargs='*', default=['small', 'medium'], choices=list(SCALES),
+                        help='scales to run (default: small medium)')
+    parser.add_argument('--surge', type=float, default=0.0, help='storm surge height [m]')
+    parser.add_argument('--layers', type=int, default=8, help='number of vertical layers')
+    parser.add_argument('--json', help='save the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        # New process for each scale, so that peak RSS is measured separately
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            result = pool.submit(run, scale, args.surge, args.layers).result()
+        report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
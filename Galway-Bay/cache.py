@@ -0,0 +1,70 @@
+''' Local forecast cache. The model time series at the configured sites
+    are kept on disk, keyed by 'ocean_time' (seconds since 1970-01-01), so
+    that each run only has to download the time steps that are not in the
+    cache yet. '''
+
+import numpy as np
+import os
+
+RETENTION = 30 * 86400 # Keep up to one month of model history [s]
+
+def load_cache(path, signature):
+    ''' Load the forecast cache. Return None if there is no cache yet, or if
+        the cache was built for a different model or site list. If signature
+        is None, the cache is not checked '''
+
+    if not os.path.isfile(path):
+        return None
+
+    with np.load(path) as f:
+        cache = {key: f[key] for key in f.files}
+
+    if str(cache.pop('signature')) != signature and signature is not None:
+        return None
+
+    return cache
+
+def save_cache(path, cache, signature):
+    ''' Write the forecast cache to disk. A temporary file is written first
+        and then renamed, so that readers never find a half-written cache '''
+
+    outdir = os.path.dirname(path)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, signature=signature, **cache)
+    os.replace(tmp, path)
+
+def update_cache(cache, time, new, **static):
+    ''' Add new time steps to the cache. "time" is an array of time stamps
+        (seconds since 1970-01-01) and "new" is a dictionary of arrays whose
+        first dimension is time. Cached time steps at or after the first new
+        time step are replaced, since a new forecast cycle revises them. Time
+        steps older than RETENTION are dropped. Keyword arguments are saved 
+        as they are (e.g. the grid cells of the sites) '''
+
+    if cache is None:
+        cache = dict(time=np.zeros(0, dtype=np.int64))
+        for key, val in new.items():
+            cache[key] = np.zeros((0,) + val.shape[1:], dtype=val.dtype)
+
+    # Keep cached steps before the first new time step...
+    keep = cache['time'] < time[0]
+    out = dict(time=np.concatenate((cache['time'][keep], time)))
+    # ... then append the new ones
+    for key, val in new.items():
+        out[key] = np.concatenate((cache[key][keep], val))
+
+    # Drop old time steps
+    recent = out['time'] >= out['time'][-1] - RETENTION
+    for key in out:
+        out[key] = out[key][recent]
+
+    # Keep any other (time-independent) entries of the cache
+    for key, val in cache.items():
+        if key not in out:
+            out[key] = val
+
+    return {**out, **static}
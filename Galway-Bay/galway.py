@@ -26,18 +26,33 @@
         This is the main script of the GALWAY container. This application
    reads the Galway Bay model forecasts to provide sea level, temperature
    and salinity forecasts to users scanning the QR codes deployed by Cuan
-   Beo around Galway Bay. 
+   Beo around Galway Bay. Sites outside the Galway Bay model (Gleninagh) 
+   are covered by the Connemara model. The models are listed in the model
+   registry of the configuration file and processed concurrently.
+
+        Run as "python galway.py" to update the outputs once, or as
+   "python galway.py --daemon" to keep running and update the outputs on a 
+   regular basis (see "daemon" below).
 
 '''
 
-from netCDF4 import Dataset, num2date
+from netCDF4 import num2date
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 from scipy import interpolate
+from scipy.spatial import cKDTree
 import numpy as np
 import pytz
-from pickle import dump
-from log import set_logger, now
-import os
+import sys
+from time import monotonic, perf_counter, sleep
+import hashlib
+from log import set_logger, now, RunRecord, write_record
+from cache import load_cache, save_cache, update_cache
+from snapshot import write_snapshot
+from source import open_dataset
+from shared import SharedArrays, attach
+import harmonics
 
 logger = set_logger()
 
@@ -74,109 +89,643 @@ def get_UTC_time(timezone, minute=False):
     return local_dt.astimezone(pytz.utc)
 
 
-def reader():
-    ''' Read Galway Bay model sea level time series at the 
-        indicated site (LAT, LON) '''
+def time_stamps(var):
+    ''' Convert the model time variable to time stamps (seconds since 
+        1970-01-01) as an int64 array, truncated to the hour '''
+
+    # Time units, e.g. "seconds since 1968-05-23 00:00:00"
+    scale = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}[var.units.split()[0]]
+    # Time origin as a time stamp
+    origin = num2date(0, var.units)
+    origin = datetime(origin.year, origin.month, origin.day, origin.hour, 
+                      origin.minute, origin.second, 0, pytz.UTC).timestamp()
+
+    stamps = origin + scale * np.asarray(var[:], dtype=np.float64)
+    # Keep hour precision only
+    return (stamps // 3600 * 3600).astype(np.int64)
+
+
+def time_index(time, stamp):
+    ''' Index of the last time step at or before the time stamp. This is
+        where the forecast window starts '''
+
+    return max(int(np.searchsorted(time, stamp, side='right')) - 1, 0)
+
+
+# Names of the model variables, as found in the ROMS output files. They can
+# be renamed for each model in the configuration file, e.g. "Connemara.zeta" 
+VARIABLES = ('lon_rho', 'lat_rho', 'ocean_time', 'zeta', 'temp', 'salt')
+
+def registry(config):
+    ''' Model registry. For each model listed in the configuration file, get
+        the THREDDS URL, the data source (see source.py), the names of the 
+        variables, the wet & dry mask (if the model has one), the sea level 
+        offset and the list of sites '''
+
+    models = {}
+    for name in config.get('models').split(','):
+        # Get model setting from the configuration file, e.g. "Galway-Bay.url"
+        get = lambda key, default=None: config.get(f'{name}.{key}', default)
+
+        models[name] = dict(name=name, url=get('url'), 
+            source=get('source', config.get('source', 'opendap')), path=get('path'),
+            replay=f"{config.get('replay', '/data/replay')}/{name}.pkl",
+            variables={var: get(var, var) for var in VARIABLES},
+            mask=get('mask'), 
+            offset=float(get('offset', 3.0)),
+            names=get('name').split(','),
+            longitudes=get('lon').split(','), latitudes=get('lat').split(','))
+
+    return models
+
+def variable(nc, model, name):
+    ''' Get a model variable by its ROMS name, as renamed in the registry '''
+    return nc.variables[model['variables'][name]]
+
+def reader(nc, model):
+    ''' Read the whole model grid: longitude, latitude, time, wet & dry mask,
+        sea level, surface temperature and surface salinity '''
         
-    url = 'http://milas.marine.ie/thredds/dodsC/IMI_ROMS_HYDRO/GALWAY_BAY_NATIVE_70M_8L_1H/AGGREGATE'
+    # Read longitude
+    x = variable(nc, model, 'lon_rho')[:]
+    # Read latitude
+    y = variable(nc, model, 'lat_rho')[:]
+    # Read sea level
+    logger.info(f'{now()} Reading sea level...')
+    zeta = variable(nc, model, 'zeta')[:] + model['offset'] # add offset
+    # Read time
+    time = time_stamps(variable(nc, model, 'ocean_time'))
+    # Read mask
+    if model['mask']:
+        logger.info(f'{now()} Reading mask...')
+        mask = nc.variables[model['mask']][:]
+    else: # No wet & dry mask in this model: always wet
+        mask = np.ones((len(time),) + x.shape)
+    # Read surface temperature
+    logger.info(f'{now()} Reading surface temperature...')
+    surface_temperature = variable(nc, model, 'temp')[:, -1, :, :]
+    # Read surface temperature
+    logger.info(f'{now()} Reading surface salinity...')
+    surface_salinity = variable(nc, model, 'salt')[:, -1, :, :]
+    logger.info(f'{now()} Finished reading from {model["name"]} THREDDS...')
     
-    with Dataset(url) as nc:
-        # Read longitude
-        x = nc.variables['lon_rho'][:]
-        # Read latitude
-        y = nc.variables['lat_rho'][:]
-        # Read sea level
-        logger.info(f'{now()} Reading sea level...')
-        zeta = nc.variables['zeta'][:] + 3.0 # add offset
-        # Read mask
+    return x, y, time, mask, zeta, surface_temperature, surface_salinity 
+
+def read_cells(var, cells, t0, layer=None):
+    ''' Read the time series of a model variable at each (eta, xi) grid
+        cell, starting from time index t0. Each distinct cell is requested
+        once, then the columns of all the cells are gathered with a single
+        fancy indexing operation. Return a (T, N) array '''
+
+    # Do not request the same cell twice
+    unique, inverse = np.unique(np.asarray(cells), axis=0, return_inverse=True)
+
+    columns = [var[t0:, idy, idx] if layer is None else var[t0:, layer, idy, idx]
+               for idy, idx in unique]
+
+    return np.ma.column_stack(columns)[:, inverse.ravel()]
+
+def fingerprint(nc, model):
+    ''' Get the fingerprint of the model grid: its shape and a hash of the
+        longitudes and latitudes. Only the edges of the grid are hashed, so
+        that checking the fingerprint on every run is cheap '''
+
+    h = hashlib.sha1()
+    for name in ('lon_rho', 'lat_rho'):
+        var = variable(nc, model, name)
+        for edge in (var[0, :], var[-1, :], var[:, 0], var[:, -1]):
+            h.update(np.ma.filled(edge, np.nan).astype(np.float64).tobytes())
+
+    M, L = variable(nc, model, 'lon_rho').shape
+
+    return f'{M}x{L}-{h.hexdigest()}'
+
+# Version of the site index. Older index files are rebuilt
+INDEX = 3
+
+def site_index(nc, model, indexfile=None, known=None):
+    ''' Get the site index: the grid cell nearest to each site (cells), the
+        land mask area of the cell (areas) and the map of grid cells that 
+        never dry out (wet). The index is saved to file and only rebuilt when
+        the model grid or the list of sites change. The grid cells whose sea
+        level series are used to determine the tidal times at the sites are
+        added by "tidal_nodes". "known" is the (signature, index) already in
+        memory, which is kept if it is still valid '''
+
+    longitudes, latitudes = model['longitudes'], model['latitudes']
+
+    # The index is only valid for this grid and this list of sites
+    signature = f"{INDEX} {fingerprint(nc, model)} {','.join(longitudes)} {','.join(latitudes)}"
+
+    if known is not None and known[0] == signature:
+        return known
+
+    index = load_cache(indexfile, signature) if indexfile else None
+    if index is not None:
+        return signature, index
+
+    logger.info(f'{now()} Building site index...')
+
+    # Read longitude and latitude of the whole grid
+    x = np.ma.getdata(variable(nc, model, 'lon_rho')[:])
+    y = np.ma.getdata(variable(nc, model, 'lat_rho')[:])
+    lon, lat = np.array(longitudes, dtype=float), np.array(latitudes, dtype=float)
+
+    # Examine mask. Differentiate betweeen land (0.0) areas, intertidal (0.5)
+    # areas and sea (1.0) areas. Why? The selected LAT, LON site may be in an
+    # intertidal area, where it is not easy to identify the exact time of the
+    # next low tide. The objective of the code below is to (1) indentify the
+    # nearest grid node where the tidal signal behaves "adequately" (i.e., no
+    # drying out); (2) extract the sea level series for that site. This time
+    # series will then be used to idenfity the time of low tide. 
+    if model['mask']:
         logger.info(f'{now()} Reading mask...')
-        mask = nc.variables['wetdry_mask_rho'][:]
-        # Read time
-        time = num2date(nc.variables['ocean_time'][:],
-                        nc.variables['ocean_time'].units)
-        # Read surface temperature
-        logger.info(f'{now()} Reading surface temperature...')
-        surface_temperature = nc.variables['temp'][:, -1, :, :]
+        grid = land_mask_areas(nc.variables[model['mask']])
+    else: # No wet & dry mask in this model: all the grid is at sea
+        grid = np.ones(x.shape)
+
+    # Grid cell nearest to each site
+    cells, _ = nearest_cells(x, y, lon, lat)
+    areas = grid[cells[:, 0], cells[:, 1]]
+
+    ''' Check if site is either land (0.0), intertidal (0.5) or sea (1.0) '''
+    for name, tipo in zip(model['names'], areas):
+        if tipo == 0.0: # Point is on land. Wrong site. Change LAT, LON
+            logger.info(f'{now()} Point is on land: {name}. It will not be published')
+
+    index = dict(cells=cells, areas=areas, wet=grid == 1.0)
+
+    if indexfile:
+        save_cache(indexfile, index, signature)
+
+    return signature, index
+
+def tidal_nodes(nc, model, index, zeta, t0=0, good=None):
+    ''' Check the sea level series of the whole grid, from time index t0, 
+        for flat segments (i.e. drying out), and get the map of good tidal 
+        nodes (good), unless it is given. Then, for each site, find the 
+        nearest grid cell that never dries out and has a good tidal signal 
+        (tidal). This is the cell itself for most sites at sea. For sites in
+        intertidal flats, the sea level series is taken from a location 
+        nearby. This is done once for each forecast cycle. Return the updated
+        site index '''
+
+    if good is None:
+        logger.info(f'{now()} Checking sea level series for flat segments...')
+        good = good_tidal_nodes(zeta, t0)
+
+    x = np.ma.getdata(variable(nc, model, 'lon_rho')[:])
+    y = np.ma.getdata(variable(nc, model, 'lat_rho')[:])
+    lon = np.array(model['longitudes'], dtype=float)
+    lat = np.array(model['latitudes'], dtype=float)
+
+    tidal, distance = nearest_cells(x, y, lon, lat, index['wet'] & good)
+    for name, cell, node, d in zip(model['names'], index['cells'], tidal, distance):
+        if tuple(cell) != tuple(node):
+            logger.info(f'{now()} Tidal times for {name} from {d:.0f} m away')
+
+    return dict(index, good=good, tidal=tidal)
+
+def site_reader(nc, model, NOW, cachefile=None, indexfile=None):
+    ''' Read model time series at the configured sites only.
+        Instead of downloading the whole grid, only the grid cells nearest to
+        each site are requested, and only for the forecast window starting at
+        the current hour (NOW). If a cache file is given, the site series are
+        kept on disk and only the time steps not yet cached are downloaded.
+        The site index and the cache are also kept in memory (STATE) while
+        the dataset handle is open. The area of each site (land, intertidal
+        or sea, see "land_mask_areas") is returned with the series '''
+
+    state = STATE.setdefault(model['name'], {})
+
+    # Get grid cells of the sites. Check them against the grid of each new handle
+    if state.get('checked') is not nc:
+        state['index'] = site_index(nc, model, indexfile, state.get('index'))
+        state['checked'] = nc
+    signature, index = state['index']
+
+    # Read time (seconds since 1970-01-01)
+    time = time_stamps(variable(nc, model, 'ocean_time'))
+    # Current time index. The forecast window starts here
+    t0 = time_index(time, NOW)
+
+    # Check the tidal nodes once for each forecast cycle
+    if index.get('cycle') != time[-1]:
+        index = tidal_nodes(nc, model, index, variable(nc, model, 'zeta'), t0)
+        index['cycle'] = time[-1]
+        state['index'] = signature, index
+        if indexfile:
+            save_cache(indexfile, index, signature)
+
+    cells = [tuple(i) for i in index['cells']]
+    N = len(cells)
+    # Tidal nodes, and the node of each site. Sites may share a node
+    nodes = sorted(set(tuple(i) for i in index['tidal']))
+    tidal = np.array([nodes.index(tuple(i)) for i in index['tidal']], dtype=np.int64)
+
+    # The cache is only valid for this model, grid and list of sites. The sea
+    # level at the tidal nodes is cached for each node, so that a change of the
+    # tidal nodes only affects the nodes that changed
+    signature = f"{model['url']} {signature}"
+    if state.get('cache', (None,))[0] == signature:
+        cache = state['cache'][1]
+    else:
+        cache = load_cache(cachefile, signature) if cachefile else None
+
+    if cache is not None and [tuple(i) for i in cache['nodes']] != nodes:
+        cache = tidal_history(nc, model, cache, nodes, time)
+
+    if cache is None:
+        start = t0
+    elif time[-1] == cache['time'][-1] and np.array_equal(cache['tidal'], tidal):
+        logger.info(f'{now()} No new forecasts in {model["name"]} THREDDS. Using cache...')
+        start = None
+    else: 
+        # New forecast cycle. Download the time steps not yet cached, 
+        # and refresh the forecast window, which is revised by the new cycle
+        start = min(np.searchsorted(time, cache['time'][-1], side='right'), t0)
+
+    if start is not None:
+        # Read sea level, both at the sites and at the tidal nodes
+        logger.info(f'{now()} Reading sea level at {N} sites...')
+        zeta = read_cells(variable(nc, model, 'zeta'), cells + nodes, start) + model['offset'] # add offset
+        # Read mask
+        if model['mask']:
+            logger.info(f'{now()} Reading mask at {N} sites...')
+            mask = read_cells(nc.variables[model['mask']], cells, start)
+        else: # No wet & dry mask in this model: always wet
+            mask = np.ones((len(time) - start, N))
         # Read surface temperature
-        logger.info(f'{now()} Reading surface salinity...')
-        surface_salinity = nc.variables['salt'][:, -1, :, :]
-        logger.info(f'{now()} Finished reading from Galway Bay THREDDS...')
-        
-    # Set time as UTC
-    time = [datetime(i.year, i.month, i.day, i.hour, 0, 0, 0, pytz.UTC) for i in time]
-        
-    return x, y, time, mask, zeta, surface_temperature, surface_salinity 
+        logger.info(f'{now()} Reading surface temperature at {N} sites...')
+        surface_temperature = read_cells(variable(nc, model, 'temp'), cells, start, layer=-1)
+        # Read surface salinity
+        logger.info(f'{now()} Reading surface salinity at {N} sites...')
+        surface_salinity = read_cells(variable(nc, model, 'salt'), cells, start, layer=-1)
+        logger.info(f'{now()} Finished reading from {model["name"]} THREDDS...')
 
-def find_nearest_indexes(x, y, lon, lat):     
-    ''' Find indexes in ROMS grid nearest to LAT, LON location '''
-    
-    xlist, ylist = x[0, :], y[:, 0]
-    # Find nearest indexes to LAT, LON
-    idx, idy = np.argmin(abs(xlist - lon)), np.argmin(abs(ylist - lat))
-    
-    return idx, idy
+        cache = update_cache(cache, time[start:], dict(
+            zeta=np.ma.filled(zeta[:, :N], np.nan), tideS=np.ma.filled(zeta[:, N:], np.nan),
+            wetdry=np.ma.filled(mask, 0), temp=np.ma.filled(surface_temperature, np.nan),
+            salt=np.ma.filled(surface_salinity, np.nan)), 
+            nodes=np.array(nodes, dtype=np.int64).reshape(-1, 2), tidal=tidal)
+
+        # Fit the tidal constituents to the sea level history at the tidal 
+        # nodes, to fall back to if the model cannot be read
+        try:
+            cache.update(harmonics.to_cache(harmonics.fit(cache['time'], cache['tideS'])))
+        except (RuntimeError, np.linalg.LinAlgError) as err:
+            logger.info(f'{now()} Tidal constituents not fitted: {err}')
+
+        if cachefile:
+            save_cache(cachefile, cache, signature)
+
+    state['cache'] = signature, cache
+    # Number of new time steps read, for the run record
+    state['new_steps'] = 0 if start is None else len(time) - start
+
+    time, series = forecast_window(cache, time[t0])
+
+    return time, dict(series, areas=index['areas'])
+
+def tidal_history(nc, model, cache, nodes, time):
+    ''' Update the tidal nodes of the cache to the new list of "nodes". The 
+        sea level history of the nodes still in use is kept, the nodes no
+        longer in use are dropped, and the history of the new nodes is read
+        back to the start of the cache, as far as the model time axis goes.
+        The rest of their history is missing. Return the updated cache '''
+
+    cached = {tuple(n): k for k, n in enumerate(cache['nodes'])}
+    new = [n for n in nodes if n not in cached]
+
+    tideS = np.full((len(cache['time']), len(nodes)), np.nan)
+    for k, n in enumerate(nodes):
+        if n in cached:
+            tideS[:, k] = cache['tideS'][:, cached[n]]
+
+    # Cached time steps still in the model time axis
+    first = int(np.searchsorted(time, cache['time'][0]))
+    rows = np.searchsorted(cache['time'], time[first:])
+    found = rows < len(cache['time'])
+    found[found] = cache['time'][rows[found]] == time[first:][found]
+
+    if new and found.any():
+        logger.info(f'{now()} Reading sea level history at {len(new)} new tidal nodes...')
+        zeta = read_cells(variable(nc, model, 'zeta'), new, first) + model['offset'] # add offset
+        tideS[np.ix_(rows[found], [nodes.index(n) for n in new])] = np.ma.filled(zeta[found], np.nan)
+
+    return dict(cache, tideS=tideS, nodes=np.array(nodes, dtype=np.int64).reshape(-1, 2))
+
+def node_harmonics(cache):
+    ''' Tidal constituents fitted to the sea level at the tidal nodes of the
+        cache, given for each site. None if there are none, or if they were
+        not fitted to the tidal nodes now in the cache '''
+
+    h = harmonics.from_cache(cache)
+    if h is None or h['coef'].shape[1] != len(cache['nodes']):
+        return None
+
+    return dict(h, coef=h['coef'][:, cache['tidal']])
+
+def forecast_window(cache, start):
+    ''' Time series in the cache from time stamp "start" (the current hour)
+        onwards. The sea level at the tidal nodes is given for each site. 
+        Missing values are masked '''
+
+    w = np.searchsorted(cache['time'], start)
+
+    return cache['time'][w::], dict(zeta=np.ma.masked_invalid(cache['zeta'][w::]), 
+        tideS=np.ma.masked_invalid(cache['tideS'][w::, cache['tidal']]), wetdry=cache['wetdry'][w::], 
+        temp=np.ma.masked_invalid(cache['temp'][w::]), salt=np.ma.masked_invalid(cache['salt'][w::]))
 
+# Length of the forecast predicted from the tidal constituents [h]
+HORIZON = 72
 
-def land_mask_areas(mask):
+def fallback_reader(model, NOW, cachefile=None, indexfile=None):
+    ''' Time series to use when the model cannot be read. If the latest
+        cached forecast still covers the next day, use it. Otherwise, predict
+        the sea level from the tidal constituents fitted to the cached sea
+        level history, and keep the mean temperature and salinity of the last
+        cached day (persistence). Raise RuntimeError if there is no cache '''
+
+    cache = STATE.get(model['name'], {}).get('cache', (None, None))[1]
+    if cache is None and cachefile:
+        # The model grid cannot be checked, so use any cache found
+        cache = load_cache(cachefile, None)
+    if cache is None or 'tidal' not in cache:
+        raise RuntimeError('No cached forecasts to fall back to')
+
+    # Current hour
+    start = NOW // 3600 * 3600
+
+    # Areas of the sites, if the site index is still known, in memory or on
+    # disk. The index file cannot be checked against the grid either
+    index = STATE.get(model['name'], {}).get('index', (None, None))[1]
+    if index is None and indexfile:
+        index = load_cache(indexfile, None)
+    areas = index['areas'] if index is not None and len(index['areas']) == len(model['names']) \
+        else np.ones(len(model['names']))
+
+    if cache['time'][-1] >= start + 86400:
+        logger.info(f'{now()} Using the latest cached forecast...')
+        time, series = forecast_window(cache, start)
+        return time, dict(series, areas=areas)
+
+    h = node_harmonics(cache)
+    if h is None:
+        raise RuntimeError('No tidal constituents to fall back to')
+
+    logger.info(f'{now()} Predicting sea level from tidal constituents...')
+    time = start + 3600 * np.arange(HORIZON, dtype=np.int64)
+    # Sea level at the tidal node of each site
+    zeta = harmonics.predict(h, time)
+    N = len(model['names'])
+
+    # Persistence of temperature and salinity
+    temp, salt = (np.broadcast_to(np.nanmean(cache[key][-24:], axis=0), (HORIZON, N)) 
+        for key in ('temp', 'salt'))
+
+    return time, dict(zeta=np.ma.masked_invalid(zeta), 
+        tideS=np.ma.masked_invalid(zeta), wetdry=np.ones((HORIZON, N)),
+        temp=np.ma.masked_invalid(temp), salt=np.ma.masked_invalid(salt), areas=areas)
+
+def grid_reader(nc, model, indexfile=None):
+    ''' Read the whole model grid, then extract the time series at the
+        configured sites. Same output as "site_reader" '''
+
+    # Get grid cells of the sites
+    _, index = site_index(nc, model, indexfile)
+
+    x, y, time, mask, zeta, surf_tem, surf_sal = reader(nc, model)
+
+    # Get the tidal nodes from the sea level of the whole grid
+    index = tidal_nodes(nc, model, index, zeta)
+
+    idy, idx = index['cells'].T
+    tidy, tidx = index['tidal'].T
+
+    return time, dict(zeta=zeta[:, idy, idx], tideS=zeta[:, tidy, tidx], 
+        wetdry=mask[:, idy, idx], temp=surf_tem[:, idy, idx], salt=surf_sal[:, idy, idx],
+        areas=index['areas'])
+
+def stream_reader(nc, model, indexfile=None, chunk=24, dtype='float64'):
+    ''' Read the whole model grid in chunks of time steps, and extract the
+        time series at the configured sites as it goes. Same output as 
+        "grid_reader", but only one chunk of each variable is held in memory
+        at a time, so that peak memory is bounded by the chunk size and not
+        by the length of the aggregate. The land, intertidal and sea areas 
+        and the map of good tidal nodes are updated chunk by chunk. The site
+        series are kept in "dtype" (e.g. float32, to halve memory use) '''
+
+    # Get grid cells of the sites
+    _, index = site_index(nc, model, indexfile)
+    idy, idx = index['cells'].T
+
+    # Read time
+    time = time_stamps(variable(nc, model, 'ocean_time'))
+    zvar, tvar, svar = (variable(nc, model, name) for name in ('zeta', 'temp', 'salt'))
+    offset = np.array(model['offset'], dtype=dtype)
+
+    series = dict(zeta=[], wetdry=[], temp=[], salt=[])
+    # Running minimum and maximum of the wet & dry mask at each grid cell
+    low, high = 1, 0
+    # Map of good tidal nodes, and the last two sea levels of the previous
+    # chunk, so that the flat segments across chunks are checked too
+    good, tail = True, None
+
+    logger.info(f'{now()} Reading {model["name"]} in chunks of {chunk} time steps...')
+    for t in range(0, len(time), chunk):
+        # Read sea level
+        zeta = zvar[t:t + chunk].astype(dtype) + offset # add offset
+        good = good & test_sea_level_series(zeta if tail is None else np.ma.concatenate((tail, zeta)))
+        tail = zeta[-2:]
+        series['zeta'].append(zeta[:, idy, idx])
+        del zeta
+
+        # Read mask
+        if model['mask']:
+            mask = np.ma.filled(nc.variables[model['mask']][t:t + chunk], 0).astype(dtype)
+            low, high = np.minimum(low, mask.min(axis=0)), np.maximum(high, mask.max(axis=0))
+            series['wetdry'].append(mask[:, idy, idx])
+            del mask
+        else: # No wet & dry mask in this model: always wet
+            series['wetdry'].append(np.ones((len(series['zeta'][-1]), len(idy)), dtype=dtype))
+
+        # Read surface temperature and surface salinity
+        series['temp'].append(tvar[t:t + chunk, -1].astype(dtype)[:, idy, idx])
+        series['salt'].append(svar[t:t + chunk, -1].astype(dtype)[:, idy, idx])
+
+    series = {key: np.ma.concatenate(val) for key, val in series.items()}
+
+    if model['mask']:
+        # Land, intertidal and sea areas of the current aggregate
+        grid = mask_areas(low, high)
+        index = dict(index, areas=grid[idy, idx], wet=grid == 1.0)
+
+    # Get the tidal nodes from the map of good tidal nodes...
+    index = tidal_nodes(nc, model, index, None, good=good)
+    # ... and read their sea level series
+    series['tideS'] = read_cells(zvar, [tuple(i) for i in index['tidal']], 0).astype(dtype) + offset
+    logger.info(f'{now()} Finished reading from {model["name"]} THREDDS...')
+
+    return time, dict(series, areas=index['areas'])
+
+def metres(lon, lat, lat0):
+    ''' Project longitudes and latitudes to metres (equirectangular projection
+        about latitude lat0). This is accurate enough at the scale of a bay '''
+
+    R = 6371000 # Earth radius [m]
+
+    return np.column_stack((R * np.radians(np.ravel(lon)) * np.cos(np.radians(lat0)), 
+                            R * np.radians(np.ravel(lat))))
+
+def nearest_cells(x, y, lon, lat, where=None):
+    ''' Find the (eta, xi) grid cells nearest to each LAT, LON location in the
+        (curvilinear) ROMS grid, and their distance [m]. If "where" is given,
+        only the grid cells where it is True are searched. A KD-tree is used,
+        so that each lookup is logarithmic in the number of grid cells '''
+
+    lat0 = np.mean(y)
+
+    # Grid cells to search
+    candidates = np.argwhere(np.ones(x.shape, dtype=bool) if where is None else where)
+    if not len(candidates):
+        raise RuntimeError('No grid cells to search')
+
+    tree = cKDTree(metres(x[tuple(candidates.T)], y[tuple(candidates.T)], lat0))
+
+    distance, i = tree.query(metres(lon, lat, lat0))
+
+    return candidates[i], distance
+
+
+def land_mask_areas(mask, chunk=24):
     ''' Given the wet & dry land mask, return an M x L array where:
         '0.0' are land areas, 
         '0.5' are intertidal areas, 
-        '1.0' are sea areas '''
-    
-    T, _, _ = mask.shape
-    
-    sea = np.sum(mask, axis=0) == T    
-    tidal = np.logical_and(np.sum(mask, axis=0) > 0, np.sum(mask, axis=0) < T)
+        '1.0' are sea areas 
+        The mask is read in chunks of time steps, so that memory use does not
+        grow with the number of time steps '''
     
-    return  sea + 0.5 * tidal
+    T = mask.shape[0]
 
+    # Minimum and maximum of the mask at each cell. Masked values are dry
+    low, high = 1, 0
+    for t in range(0, T, chunk):
+        m = np.ma.filled(mask[t:t + chunk], 0)
+        low, high = np.minimum(low, m.min(axis=0)), np.maximum(high, m.max(axis=0))
 
-def test_sea_level_series(zeta):
+    return mask_areas(low, high)
+
+def mask_areas(low, high):
+    ''' Land (0.0), intertidal (0.5) and sea (1.0) areas from the minimum
+        and maximum of the wet & dry mask at each cell: always dry, wet at
+        times, or always wet '''
+
+    sea = low == 1
+    tidal = np.logical_and(high > 0, low < 1)
+
+    return sea + 0.5 * tidal
+
+
+def test_sea_level_series(zeta, k=0.05):
     ''' Check that the sea level series in unaffected by a drying out (i.e. its
-        shape is that of a normal tidal signal, without flat values) '''
+        shape is that of a normal tidal signal, without flat values). Time is
+        the first dimension of "zeta", so many series (e.g. a T x M x L grid) 
+        are checked at once. Return True for good sea level series '''
     
-    k = 0.05 # [m]
-    
-    T = len(zeta)
-    
-    for i in range(T - 2):
-        # Get three consecutive values
-        z0, z1, z2 = zeta[i : i+3]
-        # Compute differences
-        d0, d1, d2 = abs(z1-z0), abs(z2-z1), abs(z2-z0)
-        
-        if (d0 < k) and (d1 < k) and (d2 < k): # Sea level series is flat!
-            return False # The sea level series is not adequate
-        
-    return True # Good sea level series
+    zeta = np.ma.getdata(zeta)
 
-def minute_interpolation(time, tide):
-    ''' Interpolate hourly sea level time series to minute frequency '''
-    
-    # Convert time to UNIX time stamps (seconds since 1970-01-01)
-    # This is needed because the scipy interpolating function cannot handle
-    # datetime objects as the independent variable.
-    timestamps = np.array([i.timestamp() for i in time])
-    
-    # Create cubic interpolator
-    F = interpolate.CubicSpline(timestamps, tide)
+    # Differences between three consecutive values [m]
+    d0 = abs(zeta[1:-1] - zeta[:-2])
+    d1 = abs(zeta[2:] - zeta[1:-1])
+    d2 = abs(zeta[2:] - zeta[:-2])
+
+    # Sea level series is flat!
+    flat = (d0 < k) & (d1 < k) & (d2 < k)
+
+    return ~flat.any(axis=0) # Good sea level series
+
+def good_tidal_nodes(zeta, t0=0, chunk=24):
+    ''' Map of the grid cells with a good sea level series (see 
+        "test_sea_level_series") from time index t0. "zeta" is the T x M x L 
+        sea level variable (or array). It is read in chunks of time steps, 
+        overlapping by two steps, so that memory use does not grow with T '''
+
+    T = zeta.shape[0]
+
+    good = np.ones(zeta.shape[1:], dtype=bool)
+    for t in range(t0, max(T - 2, t0 + 1), chunk):
+        good &= test_sea_level_series(zeta[t:t + chunk + 2])
+
+    return good
+
+def tidal_spline(time, tide):
+    ''' Cubic spline interpolating the hourly sea level series. The sea level
+        series at all the sites are interpolated at once: "tide" is a (T, N)
+        array for N sites and "time" are time stamps (seconds since 1970-01-01) '''
+
+    # Create cubic interpolator for all the sites
+    return interpolate.CubicSpline(time, np.ma.getdata(tide), axis=0)
+
+def minute_interpolation(F):
+    ''' Interpolate hourly sea level time series to minute frequency. Return 
+        the time stamps every minute as an int64 array (seconds since
+        1970-01-01) and the interpolated sea levels as a (T', N) array '''
     
-    # List of time stamps to interpolate to (every minute)
-    tq = np.arange(timestamps[0], timestamps[-1] + 60, 60)
+    # Time stamps to interpolate to (every minute)
+    tq = np.arange(F.x[0], F.x[-1] + 60, 60, dtype=np.int64)
         
     # Interpolate
-    tideq = np.array([F(t) for t in tq])
+    tideq = F(tq)
 
-    # What is the current index in this new time list? Convert back to datetime
-    tq = [datetime.utcfromtimestamp(i) for i in tq]
-    # Add the time zone information (UTC)
-    tq = [i.replace(tzinfo=pytz.utc) for i in tq]
-    
     return tq, tideq
 
 
-def tidal_times(time, tide):
-    ''' Find next high and low tide times and magnitudes '''
+def tide_table(F):
+    ''' Find all the high and low tides at all the sites over the whole spline
+        F in one vectorized pass. The extremes are the roots of the derivative
+        of the cubic spline, which is a quadratic polynomial in each interval,
+        so their times and sea levels are exact. Return the tide table as a 
+        dictionary of arrays sorted by site and time: site index (site), time
+        stamp (time), sea level (level) and type of extreme (type: +1 for high
+        tide, -1 for low tide) '''
+
+    # Spline coefficients in each interval, for each site: (intervals, N)
+    c0, c1, c2, c3 = F.c
+    # Length of each interval
+    h = np.diff(F.x)[:, None]
+
+    # Roots of the derivative 3 c0 s^2 + 2 c1 s + c2 in each interval
+    A, B, C = 3 * c0, 2 * c1, c2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disc = B ** 2 - 4 * A * C
+        q = -0.5 * (B + np.copysign(np.sqrt(disc), B)) # NaN if no real roots
+        roots = np.stack((np.where(A == 0, -C / B, q / A), 
+                          np.where(A == 0, np.nan, C / q)))
+    # Keep the roots within each interval. Roots at the breakpoints are only
+    # kept once, in the interval that starts there
+    inside = (roots >= 0) & (roots < h)
+    _, i, k = np.nonzero(inside)
+    s = roots[inside]
+
+    # Use the second derivative to tell minima from maxima. Exclude saddle points
+    curvature = 6 * c0[i, k] * s + 2 * c1[i, k]
+    keep = curvature != 0
+    i, k, s, curvature = i[keep], k[keep], s[keep], curvature[keep]
+
+    time = F.x[i] + s
+    level = ((c0[i, k] * s + c1[i, k]) * s + c2[i, k]) * s + c3[i, k]
+
+    order = np.lexsort((time, k))
+
+    return dict(site=k[order], time=time[order], level=level[order],
+                type=np.where(curvature[order] < 0, 1, -1).astype(np.int8))
+
+
+def tidal_times(ext, exz, kind):
+    ''' Find next high and low tide times and magnitudes from the list of
+        extremes (times, sea levels and types) of one site in the "tide_table" 
+        after the current time '''
 
     '''
             UPDATE AFTER STORM EOWYN. This function only gives 
@@ -192,47 +741,32 @@ def tidal_times(time, tide):
         by "tidal_times_crude" below
     '''
 
-    ''' EOWYN UPDATE '''
-    nex = 0 # Eowyn update: counter for the number of minima and maxima
+    # Index of the latest low tide and high tide found so far (-1 if none yet)
+    index = np.arange(len(ext))
+    lows = np.maximum.accumulate(np.where(kind < 0, index, -1)) if len(ext) else index
+    highs = np.maximum.accumulate(np.where(kind > 0, index, -1)) if len(ext) else index
+
+    # Impose that the time elapsed between low and high
+    # tide must be at least five hours! If not, keep
+    # searching for the next extreme until this is met.
+    found = (lows >= 0) & (highs >= 0)
+    found[found] = abs(ext[lows[found]] - ext[highs[found]]) > 18000
+    if found.any():
+        stop = np.argmax(found)
+    else:
+        stop = len(ext) - 1
 
-    exz, ext = [], [] # Extremes (minima or maxima) times and sea levels
+    ''' EOWYN UPDATE: count local minima and maxima found in the next hours. '''
+    nex = stop + 1
     ''' END OF EOWYN UPDATE '''
-    
-    low, high = None, None
-    
-    # Get current trend: flood (+) or ebb (-)
-    trend = tide[1] - tide[0]
-    
-    T = len(time)
-    
-    for i in range(T - 1):
-        change = tide[i + 1] - tide[i]
-        
-        if change * trend < 0: # A change in the trend sign means a minimum or a maximum 
-            ''' EOWYN UPDATE: count local minima and maxima found 
-                in the next hours. '''
-            nex += 1 # Count number of minima and maxima
-            # Append sea level to the list of extreme sea levels
-            exz.append(tide[i])
-            # Append time as well
-            ext.append(time[i])
-            ''' END OF EOWYN UPDATE '''
 
-            if trend < 0: # low tide
-                low, low_time = tide[i], time[i]
-            else: # high tide
-                high, high_time = tide[i], time[i]
-                
-        if isinstance(low, float) and isinstance(high, float):
-            # Impose that the time elapsed between low and high
-            # tide must be at least five hours! If not, keep
-            # searching for the next extreme until this is met.
-            if abs(low_time - high_time).total_seconds() > 18000:
-                break
-        
-        trend = change
-        
-    return low, low_time, high, high_time, nex, ext, exz
+    if lows[stop] < 0 or highs[stop] < 0:
+        raise RuntimeError('Tidal times not found in the forecast')
+
+    low, low_time = exz[lows[stop]], ext[lows[stop]]
+    high, high_time = exz[highs[stop]], ext[highs[stop]]
+
+    return low, low_time, high, high_time, nex
 
 def tidal_times_crude(now, ext, exz):
     ''' EOWYN UPDATE: When the number of local minima or maxima is greater
@@ -242,25 +776,23 @@ def tidal_times_crude(now, ext, exz):
     but seems to work for the Eowyn sea level signal and, hopefully, for 
     other storm surges in the future. '''
 
-    DT = timedelta(hours=12, minutes=25) # M2 period. Exclude any minima 
+    DT = timedelta(hours=12, minutes=25).total_seconds() # M2 period. Exclude any minima 
     # or maxima occurring later than this time from now (the next low and
     # high tides must surely be before this time)
 
-    low, high = 1e+3, -1e+3 # Initialize low and high tides to some dummy values
+    # Exclude the extremes occurring later than 12 h 25 min from now
+    window = ( ext - now ) <= DT
+    ext, exz = ext[window], exz[window]
 
-    for t, z in zip(ext, exz): # Loop along the minima and maxima identified by "tidal_times"
-        if ( t - now ) > DT:
-            break # Exclude the extremes occurring later than 12 h 25 min from now
-        if z > high: # Higher value found, update the high tide magnitude and time
-            high, high_time = z, t
-        if z < low:  # Lower value found, update the low tide magnitude and time
-            low, low_time   = z, t
+    # Highest and lowest values found: high and low tide magnitudes and times
+    high, low = np.argmax(exz), np.argmin(exz)
 
-    return low, low_time, high, high_time
+    return exz[low], ext[low], exz[high], ext[high]
 
 def to_string(values, wetdry, timezone):
     ''' Convert numbers and times to strings. Convert current values to "LOW TIDE" 
-    if "DRY" is the current status of the tide. This only applies for Bell Harbour '''
+    if "DRY" is the current status of the tide. This only applies for models with
+    a wet & dry mask (e.g. Bell Harbour in the Galway Bay model) '''
     
     local = pytz.timezone(timezone)
     
@@ -275,6 +807,9 @@ def to_string(values, wetdry, timezone):
             elif isinstance(val, datetime):
                 time = val.astimezone(local)                
                 GALWAY[key] = time.strftime('%a %d %H:%M')
+            elif isinstance(val, np.datetime64):
+                time = datetime.fromtimestamp(val.astype('datetime64[s]').astype(np.int64), local)
+                GALWAY[key] = time.strftime('%a %d %H:%M')
             else:
                 GALWAY[key] = val
  
@@ -287,35 +822,211 @@ def decdeg2dms(dd):
     deg,mnt = divmod(mnt, 60)
     return f'''%02dº%02d%s%.1f"''' % (deg, mnt, '´', sec)
 
-def main():
+# Warm state of each model, kept between runs in daemon mode: the open
+# dataset handle, the site index, the forecast cache and the latest forecast
+STATE = {}
+
+def dataset(model, reconnect=0):
+    ''' Get the dataset handle of a model, from the data source given in the
+        model registry. The handle is kept open in STATE and reused for up to
+        "reconnect" seconds. It has to be reopened to see the new time steps
+        added to the THREDDS aggregation, so with the default (0) a new handle
+        is opened for every forecast refresh '''
+
+    state = STATE.setdefault(model['name'], {})
+
+    if 'nc' in state and monotonic() - state['opened'] >= reconnect:
+        close(model)
+
+    if 'nc' not in state:
+        state['nc'], state['opened'] = open_dataset(model), monotonic()
+
+    return state['nc']
+
+def close(model):
+    ''' Close the dataset handle of a model '''
+
+    nc = STATE.get(model['name'], {}).pop('nc', None)
+    STATE.get(model['name'], {}).pop('checked', None)
+    if nc is not None:
+        nc.close()
+
+def update_forecast(config, model, NOW, reconnect=0, record=None):
+    ''' Read the latest forecasts of one model, interpolate the sea level and
+        find all the high and low tides in the forecast. The forecast is kept
+        in STATE, so that the outputs can be updated as time goes on without
+        reading the model again. Stages are timed in the run record '''
+
+    if record is None:
+        record = RunRecord(model['name'])
+
+    ''' Site index and forecast cache files '''
+    indexfile = f"{config.get('index')}/{model['name']}.npz" if 'index' in config else None
+    cachefile = f"{config.get('cache')}/{model['name']}.npz" if 'cache' in config else None
+
+    ''' Read model '''
+    logger.info(f'{now()} Reading from {model["name"]} THREDDS...')
+    extraction = config.get('extraction', 'sites')
+    with record.stage('read'):
+        try:
+            nc = dataset(model, reconnect)
+            transferred = nc.bytes
+            if extraction == 'grid':
+                time, series = grid_reader(nc, model, indexfile)
+            elif extraction == 'stream':
+                time, series = stream_reader(nc, model, indexfile, 
+                    int(config.get('chunk', 24)), config.get('precision', 'float64'))
+            else:
+                time, series = site_reader(nc, model, NOW, cachefile, indexfile)
+            record.data['bytes'] += nc.bytes - transferred
+        except Exception as err:
+            if extraction != 'sites':
+                raise
+            logger.info(f'{now()} Could not read from {model["name"]} THREDDS: {err}')
+            close(model)
+            time, series = fallback_reader(model, NOW, cachefile, indexfile)
+            record.data['fallback'] = str(err)
+            # Nothing was downloaded
+            STATE[model['name']]['new_steps'] = 0
+
+    # Forecast processed: time steps and number of new time steps read
+    record.data['forecast'] = dict(start=str(np.datetime64(int(time[0]), 's')), 
+        end=str(np.datetime64(int(time[-1]), 's')), steps=len(time),
+        new=STATE[model['name']].pop('new_steps', len(time)))
+
+    ''' Interpolate the sea level series with a cubic spline. The high (or low)
+        tides are found exactly from the spline derivative. The sea level series 
+        used for the tidal times at each site is taken from a neighbouring node
+        that never dries out if the site is in an intertidal flat '''
+    with record.stage('spline'):
+        ''' The sea level series of a site with missing values (e.g. masked 
+            model values at its tidal node) cannot be interpolated. It is left
+            flat, so that the spline of the other sites can still be built, 
+            and the site fails (see "site_outputs") '''
+        tideS = np.ma.filled(np.ma.masked_invalid(series['tideS']), np.nan)
+        missing = ~np.isfinite(tideS).all(axis=0)
+        if missing.any():
+            logger.info(f'{now()} Sea level missing at the tidal nodes of: '
+                        f'{", ".join(np.array(model["names"])[missing])}')
+            tideS[:, missing] = 0
+        F = tidal_spline(time, tideS)
+
+    ''' Interpolate to minute frequency for output '''
+    logger.info(f'{now()} Interpolating sea level time series to minute frequency...')
+    with record.stage('minute_interpolation'):
+        time_minfeq, tides = minute_interpolation(F)
+        tides[:, missing] = np.nan
+
+    ''' Find all the high and low tides in the forecast at all the sites '''
+    logger.info(f'{now()} Finding high and low tides...')
+    with record.stage('tide_table'):
+        table = tide_table(F)
+
+    ''' Series published in the snapshot: the sea level every minute, the
+        tide table over the whole forecast (times rounded to the minute), and
+        the tidal constituents at the tidal nodes, so that the current tide
+        can be predicted from the snapshot at any time '''
+    arrays = dict(time=time_minfeq, tide=tides.astype(np.float32),
+        table_site=table['site'].astype(np.int32), 
+        table_time=(60 * np.round(table['time'] / 60)).astype(np.int64),
+        table_level=table['level'].astype(np.float32), table_type=table['type'])
+    h = node_harmonics(STATE[model['name']].get('cache', (None, {}))[1])
+    if h is not None:
+        arrays.update(harmonics.to_cache(h))
+
+    install(model, dict(time=time, series=series, F=F, table=table, 
+        arrays=arrays, missing=missing, published=False))
+
+def install(model, latest):
+    ''' Make "latest" the forecast published for a model '''
+
+    # Free the arrays of the previous forecast shared with the site workers
+    shared = STATE.setdefault(model['name'], {}).get('forecast', {}).pop('shared', None)
+    if shared is not None:
+        shared.close()
+
+    STATE[model['name']]['forecast'] = latest
+
+def refresh_forecast(config, model, UTC, reconnect=0):
+    ''' Read the latest forecast of one model, without publishing it (daemon
+        mode). This runs in the refresh worker of the model, which keeps the
+        dataset handle, the site index and the cache. Return the status, the
+        error message (if any), the forecast and the run record '''
+
+    record = RunRecord(model['name'])
+    record.data['refresh'] = True
 
     try:
-    
-        logger.info(f'{now()} Starting GALWAY-BAY operations...')
 
-        ''' Read configuration '''
-        config = configuration()
+        logger.info(f'{now()} Refreshing {model["name"]} forecast...')
 
-        ''' Get local time as UTC '''
-        UTC = get_UTC_time(config.get('timezone'), minute=True)
-            
-        ''' Get current time to be displayed on the website '''
-        webtime=UTC.astimezone(pytz.timezone(config.get('timezone')))
-        
-        ''' Get local time as UTC (no minutes, hour precision)'''
-        UTC0 = get_UTC_time(config.get('timezone'))
+        update_forecast(config, model, int(UTC.timestamp()), reconnect, record)
 
-        ''' Get site name(s) ''' 
-        names = config.get('name').split(',')
-        
-        ''' Get site coordinates '''
-        longitudes, latitudes = config.get('lon').split(','), config.get('lat').split(',')
+        # Dataset handles are only kept open between runs if "reconnect" is set
+        if not reconnect:
+            close(model)
+
+        # The forecast is published by the daemon
+        latest = STATE[model['name']].pop('forecast')
+
+        return 0, '', latest, record.finish()
+
+    except Exception as err:
+
+        # Open a new dataset handle next time
+        close(model)
 
-        ''' Read Galway Bay model '''
-        logger.info(f'{now()} Reading from Galway Bay THREDDS...')
-        x, y, time, mask, zeta, surf_tem, surf_sal = reader()
+        return -1, str(err), None, record.finish(-1, str(err))
+
+def terminate(pool):
+    ''' Kill the worker processes of a pool (e.g. stuck in a read that never
+        returns) and shut it down without waiting for them '''
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False)
+
+def forecast_statistics(time, series, tindex):
+    ''' Current values, and forecast minima and maxima (and their times) of
+        the surface temperature and salinity from time index tindex, at all 
+        the sites at once. Each statistic is a single reduction along the 
+        time axis of the (T, N) series. Return a dictionary of (N,) arrays '''
+
+    TF = time[tindex::].astype('datetime64[s]') # Forecast time
+    stats = dict(WET_DRY=series['wetdry'][tindex])
+
+    for key, var in (('ST', 'temp'), ('SS', 'salt')):
+        F = series[var][tindex::] # Forecast at all sites
+        stats[key] = F[0] # Current value
+        # Forecast minima and maxima and their times
+        stats[f'min{key}F'], stats[f'max{key}F'] = F.min(axis=0), F.max(axis=0)
+        stats[f'min{key}Ft'], stats[f'max{key}Ft'] = TF[F.argmin(axis=0)], TF[F.argmax(axis=0)]
+
+    return stats
+
+def site_outputs(config, model, arrays, sites, webtime, NOW, tindex_minfeq):
+    ''' Get the outputs (display fields) of the given sites (indexes) from
+        the "arrays" of all the sites: current values and forecast statistics
+        (see "forecast_statistics"), current sea level (tidenow) and trend
+        (tidetrend), the tide table, the area of each site (areas) and the
+        sites with missing sea level at their tidal node (missing). A site
+        that fails (e.g. a site on land) does not stop the rest. Return a 
+        list of (site name, outputs, time taken, error) '''
+
+    names = model['names']
+    longitudes, latitudes = model['longitudes'], model['latitudes']
+
+    results = []
+
+    for k in sites:
+        name, longitude, latitude = names[k], longitudes[k], latitudes[k]
+        start = perf_counter()
+
+        try:
+            if arrays['areas'][k] == 0.0: # Point is on land. Wrong site. Change LAT, LON
+                raise RuntimeError(f'Point is on land: {name}')
+            if arrays['missing'][k]: # No tidal times without the whole sea level series
+                raise RuntimeError(f'Sea level missing at the tidal node of {name}')
 
-        for name, longitude, latitude in zip(names, longitudes, latitudes):
             # Get human-readable name of site
             nicename = name.replace("-", " ").replace("_", "'")
 
@@ -323,87 +1034,42 @@ def main():
             lon, lat = float(longitude), float(latitude)
             # Convert to DMS 
             lonstr, latstr = decdeg2dms(lon), decdeg2dms(lat)
-            
-            ''' Find nearest indexes in grid '''
-            # Current time index
-            tindex = time.index(UTC0)    
-
-            # Nearest spatial (LAT, LON) indexes
-            idx, idy = find_nearest_indexes(x, y, lon, lat)   
-            
-            ''' Get time series for the LAT, LON site '''
-            tide   = zeta[:, idy, idx] # sea level 
-            wetdry = mask[:, idy, idx] # Wet & Dry status
-            ST = surf_tem[:, idy, idx] # Surface temperature
-            SS = surf_sal[:, idy, idx] # Surface salinity
-            
+        
             ''' GET CURRENT STATUS '''   
-            WET_DRY   = wetdry[tindex]
-            surface_temperature = ST[tindex]
-            surface_salinity    = SS[tindex]
-            
-            ''' Get forecasts '''
-            TF  = time[tindex::] # Forecast time
-            STF = ST[tindex::] # Surface Temperature Forecast
-            SSF = SS[tindex::] # Surface Salinity Forecast
-            
-            ''' Get forecast minima and maxima '''
-            minSTF, maxSTF = min(STF), max(STF)
-            minSSF, maxSSF = min(SSF), max(SSF)
-            
-            ''' Get indexes of minima and maxima '''
-            minSTFi, maxSTFi = np.argmin(STF), np.argmax(STF)
-            minSSFi, maxSSFi = np.argmin(SSF), np.argmax(SSF)
-            
-            ''' Get times of minima and maxima '''
-            minSTFt, maxSTFt = TF[minSTFi], TF[maxSTFi]
-            minSSFt, maxSSFt = TF[minSSFi], TF[maxSSFi]
-                
-            # Examine mask. Differentiate betweeen land (0.0) areas, intertidal (0.5)
-            # areas and sea (1.0) areas. Why? The selected LAT, LON site may be in an
-            # intertidal area, where it is not easy to identify the exact time of the
-            # next low tide. The objective of the code below is to (1) indentify the
-            # nearest grid node where the tidal signal behaves "adequately" (i.e., no
-            # drying out); (2) extract the sea level series for that site. This time
-            # series will then be used to idenfity the time of low tide. 
-            areas = land_mask_areas(mask)
-            
-            ''' Check if site is either land (0.0), intertidal (0.5) or sea (1.0).
-                If needed, get sea level series from a neighbouring location which 
-                never dries out '''
-            tipo = areas[idy, idx]
-            if tipo == 0.0: # Point is on land. Wrong site. Change LAT, LON
-                raise RuntimeError('Point is on land')
-            elif tipo == 0.5: # Point is in an intertidal flat
-                tideS = zeta[:, 35, 81] # Exception for Bell Harbour: user Bishop's Quarter sea level for tidal times
-            elif tipo == 1.0: # Point is at sea
-                tideS = tide
-                
-            ''' Interpolate to minute frequency. This is to determine the next high (or
-            low) tide with enough precision '''
-            logger.info(f'{now()} Interpolating sea level time series to minute frequency...')
-            time_minfeq, tide = minute_interpolation(time, tideS)
-            
-            # Current time index
-            tindex_minfeq = time_minfeq.index(UTC)    
+            WET_DRY   = arrays['WET_DRY'][k]
+            surface_temperature = arrays['ST'][k]
+            surface_salinity    = arrays['SS'][k]
+        
+            ''' Get forecast minima and maxima and their times '''
+            minSTF, maxSTF = arrays['minSTF'][k], arrays['maxSTF'][k]
+            minSSF, maxSSF = arrays['minSSF'][k], arrays['maxSSF'][k]
+            minSTFt, maxSTFt = arrays['minSTFt'][k], arrays['maxSTFt'][k]
+            minSSFt, maxSSFt = arrays['minSSFt'][k], arrays['maxSSFt'][k]
             
             ''' Get current sea level '''
-            SEA_LEVEL = tide[tindex_minfeq]
-            
+            SEA_LEVEL = arrays['tidenow'][k]
+        
             ''' Find next high and low tide times and values '''
             logger.info(f'{now()} Finding next high and low tides...')
-            low, low_time, high, high_time, nex, ext, exz = \
-                tidal_times(time_minfeq[tindex_minfeq::], tide[tindex_minfeq::])
+            a, b = np.searchsorted(arrays['table_site'], [k, k + 1])
+            ext, exz, kind = (arrays[f'table_{key}'][a:b] for key in ('time', 'level', 'type'))
+            # Keep the extremes after the current time only
+            future = ext > NOW
+            ext, exz, kind = ext[future], exz[future], kind[future]
+            low, low_time, high, high_time, nex = tidal_times(ext, exz, kind)
 
             ''' EOWYN UDATE ''' 
             if nex != 2:
                 logger.info(f'{now()} Warning! There is something unusual in the series (a storm surge?)')
                 # Find tidal times with alternative method for storm surges
-                low, low_time, high, high_time = tidal_times_crude(UTC, ext, exz)
+                low, low_time, high, high_time = tidal_times_crude(NOW, ext[:nex], exz[:nex])
             ''' END OF EOWYN UPDATE '''
-                
+
+            # Round tidal times to the nearest minute
+            low_time, high_time = (np.datetime64(60 * round(i / 60), 's') for i in (low_time, high_time))
+            
             ''' Find tidal status: flood or ebb '''
-            change = tide[tindex_minfeq+1] - SEA_LEVEL
+            change = arrays['tidetrend'][k]
             if change > 0:
                 STATUS, tide1extreme, tide2extreme = 'flood', 'HIGH', 'LOW'
                 # Set next high tide
@@ -416,7 +1082,7 @@ def main():
                 tide2extremeValue, tide2extremeTime = high, high_time
                 # Set next low tide
                 tide1extremeValue, tide1extremeTime = low, low_time
-                
+            
             ''' Prepare output '''
             logger.info(f'{now()} Preparing output dictionary...')
             values = dict(tidewet=SEA_LEVEL, time=webtime,
@@ -430,32 +1096,390 @@ def main():
                 tide1extreme=tide1extreme, tide2extreme=tide2extreme,
                 tide1extremeValue=tide1extremeValue, tide1extremeTime=tide1extremeTime,
                 tide2extremeValue=tide2extremeValue, tide2extremeTime=tide2extremeTime,
-                STATUS=STATUS,  tideseries=tide, time_minfeq=time_minfeq, tindex_minfeq=tindex_minfeq, 
+                STATUS=STATUS, tindex_minfeq=tindex_minfeq, 
                           )
             logger.info(f'{now()} Converting variables to string...')
             GALWAY = to_string(values, WET_DRY, config.get('timezone'))
-            
-            outdir = '/data/pkl/Galway-Bay/'
-            if not os.path.isdir(outdir):
-                os.makedirs(outdir)
+        
+            results.append((name, GALWAY, perf_counter() - start, ''))
+        except Exception as err:
+            # Keep going with the rest of the sites
+            logger.info(f'{now()} Could not get the outputs of {name}: {err!r}')
+            results.append((name, None, perf_counter() - start, repr(err)))
 
-            outfile = f'{outdir}{name}.pkl'
-            logger.info(f'{now()} Saving to file {outfile}...')
-            with open(outfile, 'wb') as f:
-                dump(GALWAY, f)
+        logger.info('\n')
 
-            logger.info('\n')
+    return results
 
-        logger.info(f'{now()} FINISHED...')
+# Forecast arrays shared with this worker process, mapped once for each
+# forecast: {shared memory block name: (shared memory, arrays)}
+ATTACHED = {}
+
+def site_worker(config, model, name, layout, current, sites, *args):
+    ''' Run "site_outputs" in a worker process, on the forecast arrays shared
+        by the parent process (see shared.py) and the "current" values '''
+
+    if name not in ATTACHED:
+        # New forecast. Release the arrays of the previous one
+        for old in list(ATTACHED):
+            shm, arrays = ATTACHED.pop(old)
+            del arrays # Release the views before closing the shared memory
+            shm.close()
+        ATTACHED[name] = attach(name, layout)
+
+    return site_outputs(config, model, dict(ATTACHED[name][1], **current), sites, *args)
+
+def site_pool(model, workers):
+    ''' Pool of worker processes for the site outputs of a model. The pool is
+        kept in STATE and reused by every "publish" '''
+
+    state = STATE[model['name']]
+    if state.get('pool', (None,))[0] != workers:
+        release(model)
+        state['pool'] = workers, ProcessPoolExecutor(max_workers=workers)
+
+    return state['pool'][1]
+
+def release(model):
+    ''' Shut down the pool of worker processes of a model and free the 
+        forecast arrays shared with it '''
+
+    state = STATE.get(model['name'], {})
+    _, pool = state.pop('pool', (None, None))
+    if pool is not None:
+        pool.shutdown()
+    shared = state.get('forecast', {}).pop('shared', None)
+    if shared is not None:
+        shared.close()
+
+def parallel_site_outputs(config, model, latest, arrays, workers, *args):
+    ''' Run "site_outputs" in a pool of worker processes (see "site_pool").
+        The forecast arrays (the tide table) are copied into shared memory
+        once for each forecast, and only the current values, one for each
+        site, are sent with every run. The sites are split in contiguous
+        chunks, one for each worker. The results are gathered in site order,
+        so they do not depend on the number of workers. If a whole chunk 
+        fails (e.g. a worker dies), only the sites in that chunk fail '''
+
+    names = model['names']
+    chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(names)), workers)]
 
-        return 0, ''
+    pool = site_pool(model, workers)
+
+    if 'shared' not in latest:
+        latest['shared'] = SharedArrays({key: val for key, val in arrays.items() if key.startswith('table_')})
+    shared = latest['shared']
+    current = {key: val for key, val in arrays.items() if not key.startswith('table_')}
+    futures = [pool.submit(site_worker, config, model, shared.name, shared.layout, 
+        current, chunk, *args) for chunk in chunks]
+    results = []
+    for chunk, future in zip(chunks, futures):
+        try:
+            results += future.result()
+        except Exception as err:
+            logger.info(f'{now()} Could not get the outputs of {len(chunk)} sites: {err!r}')
+            results += [(names[k], None, 0.0, repr(err)) for k in chunk]
+            if isinstance(err, BrokenProcessPool):
+                # Start a new pool next time
+                release(model)
+
+    return results
+
+def publish(config, model, UTC, record=None):
+    ''' Get the current values at each site from the latest forecast of one
+        model and publish them as a new snapshot. Nothing is read from the 
+        model here, so this is fast enough to be run every minute. The time
+        taken by each site, and the error of any site that fails, are saved in
+        the run record. With "workers" in the configuration file, the sites 
+        are processed in parallel by that many worker processes '''
+
+    if record is None:
+        record = RunRecord(model['name'])
+    record.data['sites'] = {}
+
+    ''' Get current time to be displayed on the website '''
+    webtime=UTC.astimezone(pytz.timezone(config.get('timezone')))
+    
+    ''' Current time stamp (seconds since 1970-01-01) '''
+    NOW = int(UTC.timestamp())
+
+    ''' Get site name(s) ''' 
+    names = model['names']
+
+    ''' Latest forecast '''
+    latest = STATE[model['name']]['forecast']
+    time, series, F = latest['time'], latest['series'], latest['F']
+
+    # Current time index in the minute series
+    tindex_minfeq = int(np.searchsorted(latest['arrays']['time'], NOW))
+
+    # Current time index
+    tindex = time_index(time, NOW)
+
+    ''' Get current values and forecast minima and maxima at all sites, 
+        current sea level and trend: flood (+) or ebb (-), and tide table '''
+    current = dict(forecast_statistics(time, series, tindex), areas=series['areas'],
+        missing=latest['missing'], tidenow=F(NOW), tidetrend=F(NOW, 1), 
+        **{f'table_{key}': val for key, val in latest['table'].items()})
+
+    ''' Get the outputs (display fields) of each site '''
+    workers = min(int(config.get('workers', 1)), len(names))
+    if workers > 1:
+        results = parallel_site_outputs(config, model, latest, current, workers, webtime, NOW, tindex_minfeq)
+    else:
+        results = site_outputs(config, model, current, range(len(names)), webtime, NOW, tindex_minfeq)
+
+    outputs = {}
+    for name, output, elapsed, error in results:
+        record.data['sites'][name] = elapsed
+        if error:
+            record.data.setdefault('failed', {})[name] = error
+        else:
+            outputs[name] = output
+
+    ''' Publish snapshot with the outputs of all the sites '''
+    outdir = config.get('snapshot', '/data/snapshot')
+    logger.info(f'{now()} Saving snapshot to {outdir}...')
+    # The arrays are only written once for each forecast
+    arrays = None if latest['published'] else latest['arrays']
+    with record.stage('snapshot'):
+        version = write_snapshot(outdir, model['name'], outputs, arrays, 
+            sites=names, failed=record.data.get('failed'), interval=float(config.get('tick', 60)))
+    latest['published'] = True
+    record.data['version'] = version
+    logger.info(f'{now()} {model["name"]} snapshot version {version} published')
+
+def forecast(config, model, UTC, refresh=True, reconnect=0, warm=False):
+    ''' Update the outputs of one model. The model is read again if "refresh"
+        is set (or if there is no forecast yet). Otherwise, only the current
+        values are updated from the latest forecast. With "warm" (daemon 
+        mode), the pool of site workers is kept for the next run. Return the
+        status, the error message (if any) and the run record of this model '''
+
+    record = RunRecord(model['name'])
+
+    try:
+
+        logger.info(f'{now()} Starting {model["name"]} operations...')
+
+        record.data['refresh'] = refresh or 'forecast' not in STATE.get(model['name'], {})
+        if record.data['refresh']:
+            update_forecast(config, model, int(UTC.timestamp()), reconnect, record)
+
+        with record.stage('publish'):
+            publish(config, model, UTC, record)
+
+        # Dataset handles are only kept open between runs if "reconnect" is set
+        if not reconnect or not warm:
+            close(model)
+        if not warm:
+            release(model)
+
+        return 0, '', record.finish()
 
     except Exception as err:
 
-        return -1, str(err)
+        # Open a new dataset handle next time
+        close(model)
+        if not warm:
+            release(model)
+
+        return -1, str(err), record.finish(-1, str(err))
+
+def main():
+
+    record = RunRecord('galway')
+
+    try:
+    
+        logger.info(f'{now()} Starting GALWAY-BAY operations...')
+
+        ''' Read configuration '''
+        config = configuration()
+
+        ''' Read model registry '''
+        models = list(registry(config).values())
+
+        ''' Get local time as UTC '''
+        UTC = get_UTC_time(config.get('timezone'), minute=True)
+
+        ''' Process the models concurrently, each in its own worker process, so
+            that the downloads from THREDDS overlap. The netCDF library is not
+            thread-safe, so threads cannot be used here '''
+        if len(models) > 1:
+            with ProcessPoolExecutor(max_workers=len(models)) as pool:
+                results = list(pool.map(forecast, [config] * len(models), models, [UTC] * len(models)))
+        else:
+            results = [forecast(config, model, UTC) for model in models]
+
+        # Run records of each model
+        record.data['models'] = {model['name']: data for model, (_, _, data) in zip(models, results)}
+        record.data['bytes'] = sum(data['bytes'] for _, _, data in results)
+
+        errors = [f"{model['name']}: {err}" for model, (status, err, _) in zip(models, results) if status]
+
+        logger.info(f'{now()} FINISHED...')
+
+        status, err = (-1, '; '.join(errors)) if errors else (0, '')
+
+    except Exception as e:
+
+        status, err = -1, str(e)
+
+    write_record(record.finish(status, err))
+
+    return status, err
 
         
+def daemon():
+    ''' Daemon mode. Keep running, with the configuration, the model registry
+        and the state of each model (dataset handle, site index, cache and
+        latest forecast) kept in memory between runs. Every "tick" seconds
+        the current values are updated from the latest forecast, and every
+        "refresh" seconds the models are read again for new forecasts. Each
+        model has its own refresh worker process, which keeps its state, and
+        the ticks go on with the previous forecast while a refresh is running.
+        A new forecast is published as soon as it is read. A refresh still
+        running after "deadline" seconds (e.g. a THREDDS read that hangs) is
+        stopped: its worker is killed and replaced by a new one '''
+
+    logger.info(f'{now()} Starting GALWAY-BAY daemon...')
+
+    ''' Read configuration '''
+    config = configuration()
+
+    ''' Read model registry '''
+    models = list(registry(config).values())
+
+    ''' Intervals [s] '''
+    tick = float(config.get('tick', 60)) # Update of the current values
+    every = float(config.get('refresh', 300)) # Forecast refresh
+    reconnect = float(config.get('reconnect', 0)) # Reopen THREDDS datasets (0: every refresh)
+    deadline = float(config.get('deadline', 900)) # Longest refresh
+
+    ''' One refresh worker process for each model '''
+    pools = {model['name']: ProcessPoolExecutor(max_workers=1) for model in models}
+
+    refreshing = {} # Refreshes running (future and start time) of each model
+    last = {} # Start time of the latest forecast refresh of each model
+
+    def run_record():
+        record = RunRecord('galway')
+        record.data.update(refresh=False, models={}, refreshed={}, timeouts={})
+        return record
+
+    def collect(record):
+        ''' Install the forecasts of the refreshes that are finished, and stop
+            the refreshes past the deadline. Return the models with a new
+            forecast and whether any refresh failed '''
+
+        new, failed = [], False
+        for model in models:
+            name = model['name']
+            if name not in refreshing:
+                continue
+            future, started = refreshing[name]
+            if future.done():
+                del refreshing[name]
+                try:
+                    status, err, latest, data = future.result()
+                    record.data['refreshed'][name] = data
+                    record.data['bytes'] += data['bytes']
+                except BrokenProcessPool as e:
+                    # The worker died. Start a new one (with a cold state)
+                    pools[name] = ProcessPoolExecutor(max_workers=1)
+                    status, err = -1, str(e)
+                    record.data['refreshed'][name] = dict(status=status, error=err)
+                if status:
+                    # Try to refresh again on next tick
+                    failed = True
+                    logger.exception(f'Exception in {name} refresh: {err}')
+                else:
+                    last[name] = started
+                    install(model, latest)
+                    new.append(model)
+            elif monotonic() - started > deadline:
+                # Kill the stuck worker and start a new one (with a cold state)
+                del refreshing[name]
+                terminate(pools[name])
+                pools[name] = ProcessPoolExecutor(max_workers=1)
+                record.data['timeouts'][name] = round(monotonic() - started, 3)
+                failed = True
+                logger.info(f'{now()} {name} refresh timed out after {deadline} s, worker replaced')
+        return new, failed
+
+    def update(models, UTC, record):
+        ''' Publish the current values of the models from their latest forecast.
+            Return whether any model failed '''
+
+        failed = False
+        for model in models:
+            status, err, data = forecast(config, model, UTC, refresh=False, warm=True)
+            record.data['models'][model['name']] = data
+            if status:
+                failed = True
+                logger.exception(f'Exception in {model["name"]}: {err}')
+        return failed
+
+    while True:
+
+        start = monotonic()
+
+        ''' Get local time as UTC '''
+        UTC = get_UTC_time(config.get('timezone'), minute=True)
+
+        record = run_record()
+
+        _, failed = collect(record)
+
+        ''' Start the refreshes that are due. A model is never refreshed twice
+            at the same time '''
+        for model in models:
+            name = model['name']
+            if name in refreshing or start - last.get(name, -every) < every:
+                continue
+            try:
+                future = pools[name].submit(refresh_forecast, config, model, UTC, reconnect)
+            except BrokenProcessPool:
+                pools[name] = ProcessPoolExecutor(max_workers=1)
+                future = pools[name].submit(refresh_forecast, config, model, UTC, reconnect)
+            refreshing[name] = future, start
+            record.data['refresh'] = True
+
+        ''' Update the current values of the models with a forecast '''
+        ready = [model for model in models if 'forecast' in STATE.get(model['name'], {})]
+        failed = update(ready, UTC, record) or failed
+
+        write_record(record.finish(-1 if failed else 0))
+
+        logger.info(f'{now()} Run finished in {monotonic() - start:.3f} s')
+
+        # Next tick. Ticks missed while running are skipped
+        following = start + tick * (1 + (monotonic() - start) // tick)
+
+        ''' Until the next tick, publish the new forecasts as soon as they are
+            read, and stop the refreshes past the deadline '''
+        while refreshing and monotonic() < following:
+            until = min([following] + [started + deadline for _, started in refreshing.values()])
+            wait([future for future, _ in refreshing.values()],
+                timeout=max(until - monotonic(), 0), return_when=FIRST_COMPLETED)
+
+            record = run_record()
+            new, failed = collect(record)
+            if not (record.data['refreshed'] or record.data['timeouts']):
+                continue
+            record.data['refresh'] = True
+            if new:
+                UTC = get_UTC_time(config.get('timezone'), minute=True)
+                failed = update(new, UTC, record) or failed
+            write_record(record.finish(-1 if failed else 0))
+
+        sleep(max(following - monotonic(), 0))
+
 if __name__ == '__main__':   
-    status, err = main()
-    if status:
-        logger.exception(f'Exception in Galway Bay: {err}')
+    if '--daemon' in sys.argv[1:]:
+        daemon()
+    else:
+        status, err = main()
+        if status:
+            logger.exception(f'Exception in Galway Bay: {err}')
@@ -0,0 +1,55 @@
+''' Arrays shared with worker processes through shared memory. The arrays
+    are copied once into a single shared memory block, and the workers map
+    them by name, instead of receiving a pickled copy of every array. Masked
+    arrays are shared as their data and mask. '''
+
+from multiprocessing import shared_memory
+import numpy as np
+
+class SharedArrays:
+    ''' Copy a dictionary of arrays into a new shared memory block. Pass
+        "name" and "layout" to the workers (see "attach"), and call "close"
+        when the workers are done '''
+
+    def __init__(self, arrays):
+        # Split masked arrays into data and mask
+        flat = {}
+        for key, val in arrays.items():
+            flat[key] = np.ascontiguousarray(np.ma.getdata(val))
+            if np.ma.isMaskedArray(val):
+                flat[f'{key}.mask'] = np.ascontiguousarray(np.ma.getmaskarray(val))
+
+        # Data type, shape and offset of each array in the block
+        self.layout, size = {}, 0
+        for key, val in flat.items():
+            self.layout[key] = (val.dtype.str, val.shape, size)
+            size += -(-val.nbytes // 8) * 8 # Keep the arrays 8-byte aligned
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self.shm.name
+        for key, val in views(self.shm, self.layout).items():
+            val[...] = flat[key]
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def views(shm, layout):
+    ''' Arrays in a shared memory block, without copying '''
+    return {key: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            for key, (dtype, shape, offset) in layout.items()}
+
+def attach(name, layout):
+    ''' Map the arrays shared by the parent process. Return the shared memory
+        block, to be closed when done, and the dictionary of arrays. The 
+        arrays must be deleted before the block is closed '''
+
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = views(shm, layout)
+
+    # Masked arrays again
+    for key in [key for key in arrays if key.endswith('.mask')]:
+        mask = arrays.pop(key)
+        arrays[key[:-5]] = np.ma.masked_array(arrays[key[:-5]], mask=mask)
+
+    return shm, arrays
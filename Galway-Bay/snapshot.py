@@ -0,0 +1,95 @@
+''' Site snapshots. The outputs of a run for all the sites of a model are
+    published together as a snapshot: a small JSON header with the display
+    fields of each site, and the series (e.g. sea level every minute) as
+    NumPy .npy files that readers can memory-map instead of unpickling.
+
+    /data/snapshot/Galway-Bay.json                 header
+    /data/snapshot/Galway-Bay-000042.time.npy      int64 (T,)
+    /data/snapshot/Galway-Bay-000042.tide.npy      float32 (T, N sites)
+
+    Every snapshot has a new version number. The header also has a status
+    manifest: for each site, whether its outputs are up to date ("ok"), the
+    error if they are not, and when they were last updated. A site that 
+    fails keeps the display fields of its last good snapshot. If the time
+    of the next snapshot is known, it is saved as "expires", so that readers
+    (e.g. HTTP caches) know how long the snapshot is valid for. '''
+
+import numpy as np
+import json
+import glob
+import time
+import os
+
+FORMAT = 1 # Snapshot format version
+
+def read_header(outdir, model):
+    ''' Read the header of the latest snapshot of a model. Return None if
+        there is no snapshot yet '''
+
+    try:
+        with open(f'{outdir}/{model}.json', 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_snapshot(outdir, model, data, arrays, sites=None, failed=None, interval=None):
+    ''' Publish a new snapshot of the model outputs. "data" is a dictionary
+        with the display fields of each site and "arrays" is a dictionary of
+        NumPy arrays. The arrays are written first and the header last, so
+        that readers never find a header pointing to missing arrays. Arrays
+        of older versions are then removed, except those of the previous
+        snapshot, which readers that have just read its header may still
+        need. If "arrays" is None, the arrays of the previous snapshot are
+        kept. "sites" is the list of all the sites of the model, in the 
+        order of the array columns (by default, the sites in "data"), and 
+        "failed" is a dictionary with the error of each site that failed. 
+        "interval" is the time [s] until the next snapshot, if known. Return
+        the snapshot version '''
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    header = read_header(outdir, model)
+    version = header['version'] + 1 if header else 1
+
+    # Keep the arrays of the previous snapshot if there are no new ones
+    files = dict(header['arrays']) if arrays is None and header else {}
+    for key, val in (arrays or {}).items():
+        name = f'{model}-{version:06d}.{key}.npy'
+        with open(f'{outdir}/{name}.tmp', 'wb') as f:
+            np.save(f, val)
+        os.replace(f'{outdir}/{name}.tmp', f'{outdir}/{name}')
+        files[key] = name
+
+    created = int(time.time())
+
+    # Status manifest. Failed sites keep their last good display fields
+    data, status = dict(data), {}
+    previous = header or dict(data={}, status={})
+    for site in sites or list(data):
+        if site in data:
+            status[site] = dict(ok=True, error='', updated=created)
+        else:
+            error = (failed or {}).get(site, 'No outputs')
+            status[site] = dict(ok=False, error=error, updated=None)
+            if site in previous['data']:
+                data[site] = previous['data'][site]
+                status[site]['updated'] = previous.get('status', {}).get(site, {}).get(
+                    'updated', previous.get('created'))
+
+    header = dict(format=FORMAT, model=model, version=version,
+                  created=created, expires=int(created + interval) if interval else None,
+                  sites=list(sites or data), status=status, arrays=files, data=data)
+
+    with open(f'{outdir}/{model}.json.tmp', 'w') as f:
+        # NumPy scalars are saved as Python numbers
+        json.dump(header, f, default=lambda x: x.item())
+    os.replace(f'{outdir}/{model}.json.tmp', f'{outdir}/{model}.json')
+
+    # Remove arrays of older versions, but not those of the previous snapshot
+    keep = set(files.values()) | set(previous.get('arrays', {}).values())
+    for f in glob.glob(f'{outdir}/{model}-*.npy'):
+        if os.path.basename(f) not in keep:
+            os.remove(f)
+
+    return version
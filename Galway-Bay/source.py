@@ -0,0 +1,239 @@
+''' Data sources. The model datasets are opened through one of these
+    backends, selected with the "source" entry of the configuration file
+    (or "<model>.source" for a single model):
+
+        opendap   remote THREDDS dataset at "<model>.url" (default)
+        file      local NetCDF file at "<model>.path", e.g. a local mirror
+        mmap      same as "file", but the file is memory-mapped and opened
+                  by the netCDF library in in-memory mode
+        record    same as "opendap", and every read is recorded to a replay
+                  file in the "replay" directory
+        replay    serve the reads recorded in the replay file. Nothing is
+                  read from THREDDS, so the pipeline can run offline
+
+    Every backend returns a handle with the "variables" and "close" of a
+    netCDF4 Dataset. Variables only have to support the basic slicing (ints
+    and slices) used by galway.py. The handle also counts the bytes of data
+    read through it ("bytes").
+
+    A replay is not tied to the time it was recorded at. Reads that were not
+    recorded as such are cut from the recorded hyperslabs that contain them,
+    joined along the first (time) dimension if needed. So a run later than
+    the recording, whose forecast window starts a few time steps later, is
+    replayed too, up to the end of the recorded time axis. Record from a cold
+    start (empty "cache" and "index" directories), so that the whole forecast
+    window and the sea level of the whole grid are in the recording. '''
+
+from netCDF4 import Dataset
+import numpy as np
+import pickle
+import mmap
+import os
+
+SOURCES = ('opendap', 'file', 'mmap', 'record', 'replay')
+
+def open_dataset(model):
+    ''' Open the dataset of a model with the backend in the model registry '''
+
+    source = model['source']
+
+    if source == 'opendap':
+        nc = Dataset(model['url'])
+    elif source == 'file':
+        nc = Dataset(model['path'])
+    elif source == 'mmap':
+        nc = MappedDataset(model['path'])
+    elif source == 'record':
+        nc = Recorder(Dataset(model['url']), model['replay'])
+    elif source == 'replay':
+        nc = Replay(model['replay'])
+    else:
+        raise ValueError(f'Unknown data source "{source}". Use one of {", ".join(SOURCES)}')
+
+    return Metered(nc)
+
+def index_key(key):
+    ''' Hashable key for a read, e.g. var[0:, 35, 81]. NumPy integers are
+        converted to int, so that keys do not depend on the integer type '''
+
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    return tuple((i.start, i.stop, i.step) if isinstance(i, slice) else int(i) for i in key)
+
+def hyperslab(key, shape):
+    ''' Start, stop and whether the dimension is dropped (integer index) for
+        each dimension of a read, as in "index_key". None if the read is not 
+        a plain hyperslab (e.g. slices with steps) '''
+
+    key = key + ((None, None, None),) * (len(shape) - len(key))
+
+    slab = []
+    for i, n in zip(key, shape):
+        if isinstance(i, tuple):
+            start, stop, step = slice(*i).indices(n)
+            if step != 1:
+                return None
+            slab.append((start, max(stop, start), False))
+        else:
+            slab.append((i % n, i % n + 1, True))
+
+    return slab
+
+class MeteredVariable:
+    ''' Variable of a metered dataset '''
+
+    def __init__(self, metered, var):
+        self.metered, self.var = metered, var
+        self.shape = var.shape
+
+    def __getattr__(self, attr):
+        # Variable attributes, e.g. "units"
+        return getattr(self.var, attr)
+
+    def __getitem__(self, key):
+        data = self.var[key]
+        self.metered.bytes += getattr(data, 'nbytes', 0)
+        return data
+
+class Metered:
+    ''' Count the bytes of data read from a dataset. For OPeNDAP, this is
+        close to the bytes transferred, since the data are sent in binary '''
+
+    def __init__(self, nc):
+        self.nc, self.bytes = nc, 0
+        self.variables = {name: MeteredVariable(self, var) for name, var in nc.variables.items()}
+
+    def close(self):
+        self.nc.close()
+
+class MappedDataset:
+    ''' Local NetCDF file, memory-mapped and opened in in-memory mode '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.nc = Dataset(os.path.basename(path), memory=self.map)
+        self.variables = self.nc.variables
+
+    def close(self):
+        self.nc.close()
+        self.map.close()
+
+class RecordedVariable:
+    ''' Variable of a dataset being recorded. Reads are saved in the recorder '''
+
+    def __init__(self, recorder, name, var):
+        self.recorder, self.name, self.var = recorder, name, var
+        self.shape = var.shape
+
+    def __getattr__(self, attr):
+        # Variable attributes, e.g. "units"
+        return getattr(self.var, attr)
+
+    def __getitem__(self, key):
+        data = self.var[key]
+        self.recorder.reads[(self.name, index_key(key))] = data
+        return data
+
+class Recorder:
+    ''' Record every read from a dataset to a replay file. The file is
+        written when the dataset is closed. Reads already in the file (e.g.
+        from earlier runs) are kept, unless they are read again '''
+
+    def __init__(self, nc, path):
+        self.nc, self.path = nc, path
+
+        self.reads = {}
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.reads = pickle.load(f)['reads']
+
+        self.attributes = {}
+        self.variables = {}
+        for name, var in nc.variables.items():
+            self.attributes[name] = dict(shape=var.shape,
+                **{attr: var.getncattr(attr) for attr in var.ncattrs()})
+            self.variables[name] = RecordedVariable(self, name, var)
+
+    def close(self):
+        self.nc.close()
+
+        outdir = os.path.dirname(self.path)
+        if outdir and not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        with open(f'{self.path}.tmp', 'wb') as f:
+            pickle.dump(dict(attributes=self.attributes, reads=self.reads), f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+class ReplayVariable:
+    ''' Variable of a replayed dataset '''
+
+    def __init__(self, name, attributes, reads):
+        self.name, self.reads = name, reads
+        self.__dict__.update(attributes)
+        # Recorded hyperslabs of this variable, with all their dimensions
+        self.slabs = []
+        for (var, key), data in reads.items():
+            slab = hyperslab(key, self.shape) if var == name else None
+            if slab is not None:
+                self.slabs.append((slab, np.ma.asarray(data).reshape([b - a for a, b, _ in slab])))
+
+    def __getitem__(self, key):
+        key = index_key(key)
+        if (self.name, key) in self.reads:
+            return self.reads[(self.name, key)]
+
+        data = self.cut(key)
+        if data is None:
+            raise RuntimeError(f'{self.name}{list(key)} was not recorded')
+        return data
+
+    def cut(self, key):
+        ''' Cut a read from the recorded hyperslabs that contain it in all
+            dimensions but the first, joining them along the first dimension.
+            Return None if the recorded hyperslabs do not cover the read '''
+
+        want = hyperslab(key, self.shape)
+        if want is None:
+            return None
+        (start, stop, _), rest = want[0], want[1:]
+
+        # Parts of the read found in each recorded hyperslab
+        pieces = []
+        for slab, data in self.slabs:
+            if any(a > i or b < j for (a, b, _), (i, j, _) in zip(slab[1:], rest)):
+                continue
+            a, b = max(start, slab[0][0]), min(stop, slab[0][1])
+            if a < b:
+                pieces.append((a, b, data[(slice(a - slab[0][0], b - slab[0][0]),) + 
+                    tuple(slice(i - s[0], j - s[0]) for s, (i, j, _) in zip(slab[1:], rest))]))
+
+        # Join them along the first dimension, without gaps
+        parts, t = [], start
+        for a, b, piece in sorted(pieces, key=lambda p: p[0]):
+            if a > t:
+                break
+            if b > t:
+                parts.append(piece[t - a:])
+                t = b
+        if t < stop or not parts:
+            return None
+
+        # Drop the dimensions indexed with integers
+        data = np.ma.concatenate(parts).reshape([j - i for i, j, dropped in want if not dropped])
+        return data[()] if data.ndim == 0 else data
+
+class Replay:
+    ''' Replay the reads recorded by "Recorder" '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            recording = pickle.load(f)
+
+        self.variables = {name: ReplayVariable(name, attributes, recording['reads'])
+                          for name, attributes in recording['attributes'].items()}
+
+    def close(self):
+        pass
@@ -0,0 +1,147 @@
+''' Synthetic ROMS datasets. Write NetCDF files shaped like the Galway Bay
+    model output (same variable names and dimensions), so that the forecast
+    pipeline can be run and benchmarked offline, without THREDDS:
+
+        python synthetic.py synthetic.nc --size 100 200 --steps 96 --sites 16
+
+    The grid is regular in longitude and latitude, with land along the north
+    and south boundaries. The sea level is a sum of tidal constituents (M2,
+    S2, N2, K1, O1) with a phase lag across the grid, plus an optional storm
+    surge with seiches, which gives many local maxima and minima in a few
+    hours (as in storm Eowyn). Patches of intertidal flats dry out in the wet
+    & dry mask at low tide. '''
+
+from netCDF4 import Dataset
+from datetime import datetime, timezone
+import numpy as np
+import argparse
+
+# Tidal constituents: period [h] and amplitude [m]
+CONSTITUENTS = dict(M2=(12.4206, 1.60), S2=(12.0000, 0.55), N2=(12.6583, 0.30),
+                    K1=(23.9345, 0.10), O1=(25.8193, 0.08))
+
+def tide(stamps, phase, surge=0.0, surge_time=None):
+    ''' Synthetic sea level [m] at the given time stamps (seconds since
+        1970-01-01). "phase" is the tidal phase lag [rad] at each node. The
+        storm surge (if any) is a bump of height "surge" [m], centred at
+        "surge_time", with a two-hour seiche on top '''
+
+    t = stamps[:, None, None] / 3600 # [h]
+
+    zeta = np.zeros(t.shape[:1] + phase.shape)
+    for period, amplitude in CONSTITUENTS.values():
+        zeta += amplitude * np.cos(2 * np.pi * t / period - phase)
+
+    if surge:
+        h = (stamps - surge_time)[:, None, None] / 3600 # hours from the peak
+        zeta += surge * np.exp(-(h / 6) ** 2) * (1 + 0.5 * np.cos(np.pi * h))
+
+    return zeta
+
+def make(path, M=100, L=200, T=96, sites=16, patches=2, layers=8, surge=0.0,
+         start=None, seed=0):
+    ''' Write a synthetic ROMS dataset to "path" with an M x L grid, T hourly
+        time steps starting at "start" (time stamp; by default, one day ago),
+        "layers" vertical layers and "patches" intertidal patches. "surge" is
+        the height [m] of a storm surge, which peaks one day after the start.
+        Return the model registry entry (see "registry" in galway.py) with
+        "sites" sites: one in each intertidal patch, the rest at sea '''
+
+    rng = np.random.default_rng(seed)
+
+    if start is None:
+        hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        start = int(hour.timestamp()) - 86400
+
+    # Regular grid around Galway Bay
+    lon = np.linspace(-9.25, -8.90, L)
+    lat = np.linspace(53.10, 53.26, M)
+    x, y = np.meshgrid(lon, lat)
+
+    # Land along the north and south boundaries
+    coast = max(M // 10, 1)
+    land = np.zeros((M, L), dtype=bool)
+    land[:coast], land[-coast:] = True, True
+
+    # Intertidal patches next to the southern coast
+    flats = np.zeros((M, L), dtype=bool)
+    width = max(L // (2 * patches + 1), 1) if patches else 0
+    for p in range(patches):
+        flats[coast:2 * coast, (2 * p + 1) * width:(2 * p + 2) * width] = True
+
+    # Tidal phase lag, increasing eastwards
+    phase = np.pi / 4 * (x - lon[0]) / (lon[-1] - lon[0])
+
+    time = start + 3600 * np.arange(T, dtype=np.int64)
+
+    with Dataset(path, 'w') as nc:
+        nc.createDimension('ocean_time', None)
+        nc.createDimension('s_rho', layers)
+        nc.createDimension('eta_rho', M)
+        nc.createDimension('xi_rho', L)
+
+        nc.createVariable('lon_rho', 'f8', ('eta_rho', 'xi_rho'))[:] = x
+        nc.createVariable('lat_rho', 'f8', ('eta_rho', 'xi_rho'))[:] = y
+
+        var = nc.createVariable('ocean_time', 'f8', ('ocean_time',))
+        var.units = 'seconds since 1970-01-01 00:00:00'
+        var[:] = time
+
+        zeta = nc.createVariable('zeta', 'f4', ('ocean_time', 'eta_rho', 'xi_rho'))
+        mask = nc.createVariable('wetdry_mask_rho', 'f8', ('ocean_time', 'eta_rho', 'xi_rho'))
+        temp = nc.createVariable('temp', 'f4', ('ocean_time', 's_rho', 'eta_rho', 'xi_rho'))
+        salt = nc.createVariable('salt', 'f4', ('ocean_time', 's_rho', 'eta_rho', 'xi_rho'))
+
+        # Write one day at a time, so that memory use does not grow with T
+        for t0 in range(0, T, 24):
+            t = time[t0:t0 + 24]
+
+            z = tide(t, phase, surge, start + 86400)
+            zeta[t0:t0 + len(t)] = z
+
+            # Land is always dry. Intertidal flats dry out at low tide
+            wet = np.broadcast_to(~land, z.shape) & ~(flats & (z < -0.5))
+            mask[t0:t0 + len(t)] = wet
+
+            # Daily cycle of temperature and salinity, decreasing with depth
+            day = np.sin(2 * np.pi * t / 86400)[:, None, None, None]
+            depth = np.linspace(0.5, 0, layers)[None, :, None, None]
+            shape = (len(t), layers, M, L)
+            temp[t0:t0 + len(t)] = np.broadcast_to(12 + depth + day + 5 * (y - lat[0]), shape)
+            salt[t0:t0 + len(t)] = np.broadcast_to(33 - depth + 0.2 * day, shape)
+
+    # Sites: one in each intertidal patch, the rest at sea
+    sea = np.argwhere(~land & ~flats)
+    sea = sea[rng.choice(len(sea), max(sites - patches, 0), replace=False)]
+    cells = [(coast + coast // 2, (2 * p + 1) * width + width // 2) for p in range(patches)]
+    cells = cells[:sites] + [tuple(i) for i in sea]
+
+    return dict(name='Synthetic', url=path, source='file', path=path, replay=None,
+        variables={var: var for var in ('lon_rho', 'lat_rho', 'ocean_time', 'zeta', 'temp', 'salt')},
+        mask='wetdry_mask_rho', offset=3.0,
+        names=[f'Site-{i:03d}' for i in range(len(cells))],
+        longitudes=['%.6f' % lon[j] for i, j in cells],
+        latitudes=['%.6f' % lat[i] for i, j in cells])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic ROMS dataset')
+    parser.add_argument('path', help='output NetCDF file')
+    parser.add_argument('--size', nargs=2, type=int, default=(100, 200), metavar=('M', 'L'),
+                        help='grid size (eta_rho, xi_rho)')
+    parser.add_argument('--steps', type=int, default=96, help='number of hourly time steps')
+    parser.add_argument('--sites', type=int, default=16, help='number of sites')
+    parser.add_argument('--patches', type=int, default=2, help='number of intertidal patches')
+    parser.add_argument('--layers', type=int, default=8, help='number of vertical layers')
+    parser.add_argument('--surge', type=float, default=0.0, help='storm surge height [m]')
+    args = parser.parse_args()
+
+    model = make(args.path, *args.size, args.steps, args.sites, args.patches,
+                 args.layers, args.surge)
+
+    # Print the model registry entry in the format of the configuration file
+    print(f"Synthetic.source {model['source']}")
+    print(f"Synthetic.path {model['path']}")
+    print(f"Synthetic.mask {model['mask']}")
+    print(f"Synthetic.name {','.join(model['names'])}")
+    print(f"Synthetic.lon {','.join(model['longitudes'])}")
+    print(f"Synthetic.lat {','.join(model['latitudes'])}")
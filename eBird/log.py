@@ -1,7 +1,7 @@
 import logging
 def set_logger():
     logger = logging.getLogger(__name__)
-    logging.basicConfig(filename='/log/app.log', 
+    logging.basicConfig(filename='/log/app.log',
                         format='%(message)s',
                         level=logging.INFO)
     return logger
@@ -9,3 +9,60 @@ def set_logger():
 from datetime import datetime
 def now():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+''' Run records. Each run writes one JSON line to /log/runs.jsonl with the
+    wall and CPU time of each stage, bytes transferred, peak memory and any
+    other details of the run (e.g. per-site timings), to be scraped by a
+    dashboard. The file is rotated when it reaches 10 MB. '''
+
+from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
+from time import perf_counter, process_time
+import resource
+import json
+
+RECORDS = '/log/runs.jsonl'
+
+def peak_rss():
+    ''' Peak resident memory of this process [MB] '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class RunRecord:
+    ''' Record of a run. Time stages with "stage" and add any other details
+        to "data". Call "finish" at the end of the run '''
+
+    def __init__(self, job):
+        self.data = dict(job=job, start=datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                         stages={}, bytes=0)
+        self.wall, self.cpu = perf_counter(), process_time()
+
+    @contextmanager
+    def stage(self, name):
+        ''' Add the wall and CPU time [s] of this block to stage "name" '''
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            stage = self.data['stages'].setdefault(name, dict(wall=0.0, cpu=0.0))
+            stage['wall'] += perf_counter() - wall
+            stage['cpu'] += process_time() - cpu
+
+    def finish(self, status=0, error=''):
+        ''' Total wall and CPU time, peak memory and status of the run '''
+        self.data.update(wall=perf_counter() - self.wall, cpu=process_time() - self.cpu,
+                         rss=peak_rss(), status=status, error=error)
+        return self.data
+
+def write_record(data, path=RECORDS):
+    ''' Append a run record to the JSON-lines file '''
+
+    logger = logging.getLogger('runs')
+    if not logger.handlers:
+        handler = RotatingFileHandler(path, maxBytes=10 * 2**20, backupCount=5)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False # Keep records out of app.log
+
+    # NumPy scalars are saved as Python numbers
+    logger.info(json.dumps(data, default=lambda x: x.item()))
@@ -3,10 +3,14 @@ from datetime import date, datetime
 from bs4 import BeautifulSoup
 import requests
 import pickle
+import shutil
+import json
 import glob
 import os
 
-from log import set_logger, now
+from time import perf_counter
+
+from log import set_logger, now, RunRecord, write_record
 
 logger = set_logger()
 
@@ -51,6 +55,44 @@ def get_month(record):
     return datetime.strptime(record.get('obsDt'),
             '%Y-%m-%d %H:%M').month
 
+def marker_key(lon, lat):
+    ''' Key of a map marker: its coordinates, rounded to 5 decimal places
+        (about 1 m). The webapp uses the same key to find the sightings at
+        the clicked marker (see "marker_key" in webapp/app/views.py) '''
+    return '%.5f,%.5f' % (float(lat), float(lon))
+
+def publish_pictures(outdir, pictures, www='www'):
+    ''' Publish the bird pictures shown on the website to the folder served
+        by the webapp as static files ("www" in the bird folder), keeping the
+        <site>/<month>/<species>.jpg layout. Pictures are hard-linked, or 
+        copied if the file system does not allow it, and pictures no longer
+        shown are removed. Return the number of pictures published '''
+
+    www = f'{outdir}{www}/'
+
+    published = set()
+    for pic in pictures:
+        if not os.path.isfile(pic):
+            continue # Picture not downloaded
+        name = os.path.relpath(pic, outdir)
+        target = f'{www}{name}'
+        published.add(target)
+        if os.path.isfile(target):
+            continue # Already published
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(pic, f'{target}.tmp')
+        except OSError:
+            shutil.copy2(pic, f'{target}.tmp')
+        os.replace(f'{target}.tmp', target)
+
+    # Remove pictures no longer shown
+    for f in glob.glob(f'{www}*/*/*.jpg'):
+        if f not in published:
+            os.remove(f)
+
+    return len(published)
+
 def create_bird_archive(archive):
     ''' Initialize a bird archive. This will contain a
         history of the records found at the different sites '''
@@ -82,9 +124,10 @@ def remove_duplicated_records(local):
 
     return data
 
-def main():
+def main(record):
     ''' Generate map and download pictures
-        of birds in Galway Bay from eBird '''
+        of birds in Galway Bay from eBird. Stages
+        and sites are timed in the run record '''
 
     config = configuration()
     
@@ -113,7 +156,11 @@ def main():
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
+    record.data.update(sites={}, records=0, pictures=0)
+
     for pier, lon, lat in zip(names, longitudes, latitudes):
+        start = perf_counter()
+
         # Check if a bird archive exists from a previous run
         archive = f'{outdir}{pier}.pkl'
         if os.path.isfile(archive):
@@ -124,12 +171,16 @@ def main():
             BIRDS = {} # Empty archive
 
         logger.info(f'{now()} Getting latest records from eBird API for {pier}')
-        records = get_nearby_observations(
-                config.get('key'),               # eBird API key
-                float(lat),                      # Latitude
-                float(lon),                      # Longitude
-                dist=float(config.get('dist')),  # Search radius [km]
-                back=30)                         # Search last month
+        with record.stage('api'):
+            records = get_nearby_observations(
+                    config.get('key'),               # eBird API key
+                    float(lat),                      # Latitude
+                    float(lon),                      # Longitude
+                    dist=float(config.get('dist')),  # Search radius [km]
+                    back=30)                         # Search last month
+        # Size of the API response (as JSON)
+        record.data['bytes'] += len(json.dumps(records))
+        record.data['records'] += len(records)
 
         if not records:
             logger.warning(f'{now()} No records found for {pier}')
@@ -167,29 +218,36 @@ def main():
             if os.path.isfile(filename):
                 continue # Picture already downloaded
 
-            # Set URL for this species
-            url = f'{root}{species}'
-            # Request HTML content
-            cont = requests.get(url, headers=headers).content
-
-            soup = BeautifulSoup(cont, 'html.parser')
-            # Get full list of images in HTML
-            imgall = soup.find_all('img')
-
-            for img in imgall: # Loop along images in HTML
-                src = img.get('src')
-                if not 'logos' in src: # Ignore logos. We just want the birds!
-                    r = requests.get(src).content
-                    with open(filename, 'wb+') as f:
-                        f.write(r)
-                        logger.info(f'{now()}   {filename} downloaded successfully')
-                        break
-
-        # Remove duplicated records in archive
-        BIRDS = remove_duplicated_records(BIRDS)
-        # Write archive to disk
-        with open(archive, 'wb') as f:
-            pickle.dump(BIRDS, f)
+            with record.stage('pictures'):
+                # Set URL for this species
+                url = f'{root}{species}'
+                # Request HTML content
+                cont = requests.get(url, headers=headers).content
+                record.data['bytes'] += len(cont)
+
+                soup = BeautifulSoup(cont, 'html.parser')
+                # Get full list of images in HTML
+                imgall = soup.find_all('img')
+
+                for img in imgall: # Loop along images in HTML
+                    src = img.get('src')
+                    if not 'logos' in src: # Ignore logos. We just want the birds!
+                        r = requests.get(src).content
+                        record.data['bytes'] += len(r)
+                        record.data['pictures'] += 1
+                        with open(filename, 'wb+') as f:
+                            f.write(r)
+                            logger.info(f'{now()}   {filename} downloaded successfully')
+                            break
+
+        with record.stage('archive'):
+            # Remove duplicated records in archive
+            BIRDS = remove_duplicated_records(BIRDS)
+            # Write archive to disk
+            with open(archive, 'wb') as f:
+                pickle.dump(BIRDS, f)
+
+        record.data['sites'][pier] = perf_counter() - start
 
     month = date.today().month
     # Current month name
@@ -198,51 +256,73 @@ def main():
     # Post-process archive files to filter out only those
     # sightings that should be included on the website.
 
-    files = glob.glob(f'{outdir}*.pkl')
-    for file in files:
-        if 'WEB' in file: continue
-        # Get site name
-        site = file[0:-4]; logger.info(f'{now()} Preparing web output for {site}...')
-
-        # Dictionary with longitudes, latitude, times, 
-        # scientific and common names, and pictures.
-        web = {'lonBird': [], 'latBird': [], 't': [], 'sc': [], 'cm': [], 'pic': [], 'loc': []}
+    # Pictures shown on the website
+    pictures = []
+
+    with record.stage('web'):
+        files = glob.glob(f'{outdir}*.pkl')
+        for file in files:
+            if 'WEB' in file: continue
+            # Get site name
+            site = file[0:-4]; logger.info(f'{now()} Preparing web output for {site}...')
+
+            # Dictionary with longitudes, latitude, times, 
+            # scientific and common names, and pictures. The
+            # same sightings are also grouped by map marker.
+            web = {'lonBird': [], 'latBird': [], 't': [], 'sc': [], 'cm': [], 'pic': [], 'loc': [],
+                   'markers': {}}
         
-        with open(file, 'rb') as f:
-            data = pickle.load(f)
-
-        if data:
-            # Month to take observations from for this site
-            month_i = monthly_observations(data, month)
-            # Get name of this month
-            month_istr = date(2000, month_i, 1).strftime('%B')
-
-            web['title'] = f'Birds in {month_istr}'
-
-            for k, v in data.items():
-                # Get time of observation
-                time = datetime.strptime(v[3], '%Y-%m-%d %H:%M')
-                if time.month == month_i: 
-                    web['cm'].append(v[1])  # Append common name
-                    web['sc'].append(v[2])  # Append scientific name
-                    web['t'].append(v[3])   # Append time of observation
-                    web['loc'].append(v[4]) # Append site of observation
-                    web['lonBird'].append(v[5]) # Append longitude
-                    web['latBird'].append(v[6]) # Append latitude
-                    # Append path to bird picture
-                    web['pic'].append(f'{site}/%02d/{v[0]}.jpg' % time.month)
-
-        else: # No data available for this site (yet)
-            web['title'] = f'No bird observations for this site (yet)'
-
-        # Export to new file
-        with open(f'{site}-WEB.pkl', 'wb') as f:
-            pickle.dump(web, f)
+            with open(file, 'rb') as f:
+                data = pickle.load(f)
+
+            if data:
+                # Month to take observations from for this site
+                month_i = monthly_observations(data, month)
+                # Get name of this month
+                month_istr = date(2000, month_i, 1).strftime('%B')
+
+                web['title'] = f'Birds in {month_istr}'
+
+                for k, v in data.items():
+                    # Get time of observation
+                    time = datetime.strptime(v[3], '%Y-%m-%d %H:%M')
+                    if time.month == month_i: 
+                        web['cm'].append(v[1])  # Append common name
+                        web['sc'].append(v[2])  # Append scientific name
+                        web['t'].append(v[3])   # Append time of observation
+                        web['loc'].append(v[4]) # Append site of observation
+                        web['lonBird'].append(v[5]) # Append longitude
+                        web['latBird'].append(v[6]) # Append latitude
+                        # Append path to bird picture
+                        web['pic'].append(f'{site}/%02d/{v[0]}.jpg' % time.month)
+                        # Add to the sightings at this location
+                        marker = web['markers'].setdefault(marker_key(v[5], v[6]), 
+                            dict(lon=v[5], lat=v[6], sightings=[]))
+                        marker['sightings'].append(dict(cm=v[1], sc=v[2], t=v[3], loc=v[4], 
+                            pic=web['pic'][-1]))
+
+            else: # No data available for this site (yet)
+                web['title'] = f'No bird observations for this site (yet)'
+
+            # Export to new file
+            with open(f'{site}-WEB.pkl', 'wb') as f:
+                pickle.dump(web, f)
+
+            pictures += web['pic']
+
+    # Publish the pictures to the folder served by the webapp, so that
+    # nothing has to be copied when users click on the map
+    with record.stage('publish'):
+        record.data['published'] = publish_pictures(outdir, pictures)
 
     logger.info(f'{now()} END')
 
 if __name__ == '__main__':
+    record = RunRecord('ebird')
     try:
-        main()
+        main(record)
+        record.finish()
     except Exception as e:
         logger.error(str(e))
+        record.finish(-1, str(e))
+    write_record(record.data)
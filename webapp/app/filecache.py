@@ -0,0 +1,69 @@
+''' In-process cache of the files loaded by the webapp (eBird pickles,
+    snapshot headers and the tidal constituents of stale snapshots). Each
+    uWSGI worker keeps its own cache. Files are loaded again only if their
+    modification time or size changed, and they are checked at most once
+    every few seconds, so that a burst of requests for the same dashboard
+    costs a dictionary lookup per file. The least recently used files are
+    evicted when the cache is full. Cached objects are shared between 
+    requests and must not be modified. '''
+
+from collections import OrderedDict
+from threading import Lock
+import time
+import os
+
+class FileCache:
+    ''' Cache of up to "size" files, checked against the file system at
+        most once every "interval" seconds '''
+
+    def __init__(self, size=256, interval=2.0):
+        self.size, self.interval = size, interval
+        self.entries = OrderedDict() # path: (mtime, size, checked, value)
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = Lock()
+
+    def get(self, path, loader):
+        ''' Get the contents of a file, as loaded by "loader(path)". Raise
+            FileNotFoundError if the file does not exist '''
+        return self.entry(path, loader)[0]
+
+    def entry(self, path, loader):
+        ''' Same as "get", but return the contents together with the 
+            modification time [ns] and size of the file they were loaded 
+            from, e.g. to build HTTP cache validators that always match the
+            contents served '''
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry[2] < self.interval:
+                self.hits += 1
+                self.entries.move_to_end(path)
+                return entry[3], entry[0], entry[1]
+
+        stat = os.stat(path)
+        with self.lock:
+            if entry is not None and (entry[0], entry[1]) == (stat.st_mtime_ns, stat.st_size):
+                # Unchanged: check again after the interval
+                self.hits += 1
+                self.entries[path] = (entry[0], entry[1], now, entry[3])
+                self.entries.move_to_end(path)
+                return entry[3], entry[0], entry[1]
+            self.misses += 1
+
+        value = loader(path)
+
+        with self.lock:
+            self.entries[path] = (stat.st_mtime_ns, stat.st_size, now, value)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return value, stat.st_mtime_ns, stat.st_size
+
+    def stats(self):
+        ''' Hit and miss counters of this worker '''
+        with self.lock:
+            return dict(pid=os.getpid(), files=len(self.entries), hits=self.hits,
+                        misses=self.misses, evictions=self.evictions)
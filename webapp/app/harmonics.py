@@ -0,0 +1,130 @@
+''' Harmonic analysis of the sea level. The main tidal constituents are fitted
+    by least squares to the sea level history of all the sites at once, so
+    that the sea level and the next high and low tides can be predicted at
+    any time without reading the model. The constituents are not corrected
+    for the 18.6-year nodal cycle, so predictions are only reliable for
+    weeks to months after the fitted history. '''
+
+import numpy as np
+
+# Angular speed of the main tidal constituents [degrees per hour], in order
+# of importance. Constituents are only fitted if the history is long enough
+# to tell them from the constituents already chosen (see "constituents")
+SPEEDS = {'M2': 28.9841042, 'S2': 30.0000000, 'N2': 28.4397295, 'K1': 15.0410686,
+          'O1': 13.9430356, 'K2': 30.0821373, 'P1': 14.9589314, 'Q1': 13.3986609,
+          'M4': 57.9682084, 'MS4': 58.9841042, 'MN4': 57.4238337, 'M6': 86.9523127,
+          '2N2': 27.8953548, 'NU2': 28.5125831, 'L2': 29.5284789, 'MU2': 27.9682084}
+
+def constituents(hours):
+    ''' Constituents that can be fitted to a history of this length [h]. By
+        the Rayleigh criterion, two constituents can only be told apart if
+        the history is longer than their synodic period, 360 / |speed1 - speed2| '''
+
+    chosen = []
+    for name, speed in SPEEDS.items():
+        if speed * hours < 360: # Not even one period
+            continue
+        if all(abs(speed - SPEEDS[i]) * hours >= 360 for i in chosen):
+            chosen.append(name)
+    return chosen
+
+def fit(time, zeta):
+    ''' Fit the tidal constituents to the sea level series. "time" are time
+        stamps (seconds since 1970-01-01) and "zeta" is a (T, N) array for N
+        sites. Time steps with missing values at any site are ignored. Return
+        the harmonic constants: names and speeds of the constituents, time
+        origin (epoch) and a (2K + 1, N) array of coefficients (mean sea level,
+        then the cosine and sine amplitudes of each constituent) '''
+
+    zeta = np.ma.filled(zeta, np.nan)
+    valid = np.all(np.isfinite(zeta), axis=1)
+    time, zeta = np.asarray(time)[valid], zeta[valid]
+
+    names = constituents((time[-1] - time[0]) / 3600)
+    if 2 * len(names) + 1 > len(time):
+        raise RuntimeError('Not enough sea level data to fit the tidal constituents')
+
+    h = dict(names=np.array(names), speeds=np.array([SPEEDS[i] for i in names]),
+             epoch=np.int64(time[0]))
+
+    # Least squares fit of all the sites at once
+    h['coef'] = np.linalg.lstsq(design(h, time), zeta, rcond=None)[0]
+
+    return h
+
+def design(h, time):
+    ''' Least squares design matrix: one column for the mean, then the cosine
+        and sine of the phase of each constituent at the given times '''
+
+    phase = phases(h, time)
+
+    A = np.empty((len(phase), 2 * phase.shape[1] + 1))
+    A[:, 0] = 1
+    A[:, 1::2], A[:, 2::2] = np.cos(phase), np.sin(phase)
+    return A
+
+def phases(h, time):
+    ''' Phase [rad] of each constituent at the given times, as a (T, K) array '''
+
+    omega = np.radians(h['speeds']) / 3600 # [rad/s]
+    return (np.asarray(time, dtype=np.float64) - h['epoch'])[:, None] * omega
+
+def predict(h, time, derivative=0, sites=None):
+    ''' Predict the sea level (or its time derivative) at the given times.
+        Return a (T, N) array. If "sites" is given (an array of site indexes,
+        as long as "time"), return the prediction at each time for that site
+        only, as a (T,) array '''
+
+    omega = np.radians(h['speeds']) / 3600 # [rad/s]
+    phase = phases(h, time)
+    coef = h['coef'] if sites is None else h['coef'][:, sites].T # (T, 2K + 1)
+
+    # Derivatives of cos(w t) and sin(w t) cycle through +-sin and +-cos
+    c, s = np.cos(phase), np.sin(phase)
+    for i in range(derivative):
+        c, s = -s * omega, c * omega
+
+    if sites is None:
+        z = c @ coef[1::2] + s @ coef[2::2]
+        return z + coef[0] if derivative == 0 else z
+    else:
+        z = np.sum(c * coef[:, 1::2] + s * coef[:, 2::2], axis=1)
+        return z + coef[:, 0] if derivative == 0 else z
+
+def next_extremes(h, start, hours=26, step=600):
+    ''' Next high and low tides at each site after time stamp "start",
+        searched over the following hours. The sea level derivative is
+        sampled every "step" seconds and its roots are refined with a Newton
+        step. Return high tide times, high tides, low tide times and low tides
+        as (N,) arrays. Times are NaN if no extreme is found '''
+
+    time = start + np.arange(0, hours * 3600 + step, step)
+    dz = predict(h, time, 1)
+    sites = np.arange(dz.shape[1])
+
+    out = []
+    for crossing in ((dz[:-1] > 0) & (dz[1:] <= 0), # High tide: rising, then falling
+                     (dz[:-1] < 0) & (dz[1:] >= 0)): # Low tide: falling, then rising
+        # First crossing at each site
+        i = np.argmax(crossing, axis=0)
+        d0, d1 = dz[i, sites], dz[i + 1, sites]
+        # Linear interpolation of the derivative root...
+        t = time[i] + step * d0 / np.where(d0 == d1, 1, d0 - d1)
+        # ... and one Newton step
+        t = t - predict(h, t, 1, sites) / predict(h, t, 2, sites)
+        t = np.where(crossing.any(axis=0), t, np.nan)
+        out += [t, predict(h, np.nan_to_num(t), 0, sites)]
+
+    return tuple(out)
+
+def to_cache(h, prefix='harmonics'):
+    ''' Harmonic constants as flat entries of a cache or snapshot '''
+    return {f'{prefix}_{key}': val for key, val in h.items()}
+
+def from_cache(cache, prefix='harmonics'):
+    ''' Harmonic constants from the entries of a cache or snapshot. Return
+        None if there are none '''
+
+    if f'{prefix}_coef' not in cache:
+        return None
+    return {key: cache[f'{prefix}_{key}'] for key in ('names', 'speeds', 'epoch', 'coef')}
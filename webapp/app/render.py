@@ -0,0 +1,88 @@
+''' Pre-rendered dashboards. The dashboard of each site is rendered to a
+    static HTML file whenever its snapshot or its bird observations change,
+    so that nginx serves the dashboards directly (see nginx.conf), and only
+    falls back to Flask if there is no file for a site. Run by uWSGI next to
+    the app (see render.py and uwsgi.ini):
+
+    /data/html/Galway-Bay/<site>/index.html '''
+
+from app.views import dashboard, find_snapshot, FILES, load_json, STALE
+from app import app
+import traceback
+import glob
+import time
+import sys
+import os
+
+HTML = '/data/html'
+
+def sites():
+    ''' Sites in the latest model snapshots '''
+    names = []
+    for header in glob.glob('/data/snapshot/*.json'):
+        try:
+            names += list(FILES.get(header, load_json).get('data', {}))
+        except (FileNotFoundError, ValueError):
+            continue
+    return names
+
+def signature(site):
+    ''' Everything the dashboard of a site depends on: the snapshot version,
+        the bird observations and, if the snapshot is stale (i.e. the tide is
+        predicted from the tidal constituents), the current minute '''
+    found = find_snapshot(site)
+    if found is None:
+        return None
+    _, header = found
+    try:
+        birds = os.stat(f'/data/BIRDS/{site}-WEB.pkl').st_mtime_ns
+    except FileNotFoundError:
+        birds = 0
+    # Last good update of the site (see "snapshot" in views.py)
+    updated = header.get('status', {}).get(site, {}).get('updated') or header.get('created', 0)
+    minute = int(time.time() // 60) if time.time() - updated > STALE else 0
+    return header['model'], header['version'], birds, minute
+
+def render(site):
+    ''' Render the dashboard of a site to its static file. The file is
+        replaced atomically, so nginx never serves a partial page '''
+    path = f'{HTML}/Galway-Bay/{site}/index.html'
+    with app.test_request_context(f'/Galway-Bay/{site}/'):
+        html = dashboard(site)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(html)
+    os.replace(f'{path}.tmp', path)
+
+def remove(site):
+    ''' Remove the static file of a site, so that Flask serves it again '''
+    try:
+        os.remove(f'{HTML}/Galway-Bay/{site}/index.html')
+    except FileNotFoundError:
+        pass
+
+def loop(interval=5):
+    ''' Check the sites every "interval" seconds and render the dashboards
+        that changed '''
+
+    rendered = {} # Signature of each rendered dashboard
+    while True:
+        current = set(sites())
+        for site in current:
+            try:
+                sig = signature(site)
+                if sig != rendered.get(site):
+                    render(site)
+                    rendered[site] = sig
+            except Exception:
+                # Leave this site to Flask until it renders again
+                traceback.print_exc(file=sys.stderr)
+                remove(site)
+                rendered.pop(site, None)
+
+        # Sites no longer published
+        for site in set(rendered) - current:
+            remove(site)
+            del rendered[site]
+
+        time.sleep(interval)
@@ -1,18 +1,192 @@
-from flask import render_template, request, url_for, redirect
+from flask import render_template, request, url_for, redirect, jsonify, abort
+from app.harmonics import from_cache, predict, next_extremes
+from app.filecache import FileCache
+from datetime import datetime, timedelta
 from pickle import load
 from app import app
-import shutil
+import numpy as np
+import pytz
+import json
+import glob
+import time
 import os
 
+# Snapshots older than this [s] are stale (i.e. the back-end is not running)
+STALE = 900
+
+# Time [s] that clients may cache the bird observations, updated daily
+BIRDS_MAX_AGE = 3600
+
+TIMEZONE = pytz.timezone('Europe/Dublin')
+
+# Files loaded by this worker (see filecache.py)
+FILES = FileCache()
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return load(f)
+
+def load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def marker_key(lon, lat):
+    ''' Key of a map marker: its coordinates, rounded to 5 decimal places.
+        Same as "marker_key" in eBird/main.py '''
+    return '%.5f,%.5f' % (float(lat), float(lon))
+
+def load_birds(path):
+    ''' Load the eBird observations of a site. Observations exported before
+        they were grouped by map marker are grouped here, once per file '''
+    data = load_pickle(path)
+    if 'markers' not in data:
+        data['markers'] = {}
+        for lon, lat, t, cm, sc, pic, loc in zip(*(data.get(key, []) for key in 
+                ('lonBird', 'latBird', 't', 'cm', 'sc', 'pic', 'loc'))):
+            data['markers'].setdefault(marker_key(lon, lat), dict(lon=lon, lat=lat, 
+                sightings=[]))['sightings'].append(dict(cm=cm, sc=sc, t=t, loc=loc, pic=pic))
+    return data
+
 def dataload(pkl, dic):
     ''' Load data from container. Update dictionary '''
     try:
-        with open(pkl, 'rb') as f:
-            var = load(f)
+        var = FILES.get(pkl, load_birds if pkl.endswith('-WEB.pkl') else load_pickle)
     except FileNotFoundError:
         var = {}
     return {**dic, **var}
 
+def find_snapshot(site):
+    ''' Find the latest model snapshot with this site. Only the snapshot 
+        headers are read. Return the snapshot folder and header, or None '''
+    for header in glob.glob('/data/snapshot/*.json'):
+        try:
+            var = FILES.get(header, load_json)
+        except (FileNotFoundError, ValueError):
+            continue
+        if site in var.get('data', {}):
+            return os.path.dirname(header), var
+    return None
+
+def validators(site, header):
+    ''' Cache validators of the display fields of a site: ETag (from the
+        snapshot version), time of last modification and time [s] until the
+        next snapshot. While the snapshot is stale, the tide is predicted 
+        again every minute, so the validators change every minute '''
+    status = header.get('status', {}).get(site, {})
+    updated = status.get('updated') or header.get('created', 0)
+    now = time.time()
+    if now - updated > STALE:
+        minute = int(now // 60 * 60)
+        return f"{header['model']}-{header['version']}-{minute}", minute, minute + 60 - now
+    expires = header.get('expires') or header.get('created', 0) + 60
+    return f"{header['model']}-{header['version']}", header.get('created', 0), expires - now
+
+def conditional(payload, etag, modified, max_age):
+    ''' JSON response with cache validators (ETag, Last-Modified) and 
+        Cache-Control. If the client already has this version (If-None-Match
+        or If-Modified-Since), the response is 304 Not Modified and the 
+        payload function is not even called '''
+    response = app.response_class(mimetype='application/json')
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(modified, pytz.UTC)
+    response.cache_control.public = True
+    response.cache_control.max_age = max(int(max_age), 0)
+    response.make_conditional(request)
+    if response.status_code != 304:
+        response.set_data(json.dumps(payload()))
+    return response
+
+def picture_url(pic):
+    ''' URL of a bird picture. The pictures are published by the eBird
+        container to /data/BIRDS/www, which is linked from the static folder
+        (see prestart.sh), so nginx serves them directly '''
+    return url_for('static', filename=f"BIRDS/{os.path.relpath(pic, '/data/BIRDS/')}")
+
+def snapshot(site, dic):
+    ''' Load the display fields of a site from the latest model snapshots 
+        published by the back-end containers. If the site failed in the 
+        latest run, its last good display fields are shown, and the time of
+        the last good update (lastgood). Update dictionary '''
+    found = find_snapshot(site)
+    if found is None:
+        return dic
+    outdir, header = found
+    data = {**dic, **header['data'][site]}
+    status = header.get('status', {}).get(site, {})
+    updated = status.get('updated') or header.get('created', 0)
+    if not status.get('ok', True):
+        data['lastgood'] = datetime.fromtimestamp(updated, TIMEZONE).strftime('%a %d %H:%M')
+    if time.time() - updated > STALE:
+        data = harmonic_tide(outdir, header, site, data)
+    return data
+
+def tide_table(site, start, end):
+    ''' High and low tides at a site between two time stamps, sliced from
+        the tide table in the snapshot. The table is sorted by site and time,
+        so only the rows needed are read from the memory-mapped arrays. 
+        Return a list of tides (time, sea level and type) '''
+    found = find_snapshot(site)
+    if found is None:
+        return []
+    outdir, header = found
+    names = header['arrays']
+    if 'table_site' not in names:
+        return []
+    table = {key: np.load(f'{outdir}/{names[f"table_{key}"]}', mmap_mode='r')
+             for key in ('site', 'time', 'level', 'type')}
+
+    # Rows of this site...
+    k = header['sites'].index(site)
+    a, b = np.searchsorted(table['site'], [k, k + 1])
+    # ... between start and end
+    a, b = a + np.searchsorted(table['time'][a:b], [start, end])
+
+    return [dict(time=datetime.fromtimestamp(int(t), TIMEZONE).isoformat(),
+                 level=round(float(z), 2), type='HIGH' if kind > 0 else 'LOW')
+            for t, z, kind in zip(table['time'][a:b], table['level'][a:b], table['type'][a:b])]
+
+def harmonic_tide(outdir, header, site, dic):
+    ''' Predict the current sea level, tidal status and next high and low 
+        tides from the tidal constituents in the snapshot. Used when the 
+        snapshot is stale. Update dictionary '''
+    try:
+        # Only the tidal constituents are loaded, once per snapshot version
+        h = from_cache({key: FILES.get(f'{outdir}/{name}', np.load) 
+                        for key, name in header['arrays'].items() if key.startswith('harmonics_')})
+    except (FileNotFoundError, ValueError):
+        return dic
+    if h is None:
+        return dic
+
+    k = header['sites'].index(site)
+    # Current time to minute precision
+    now = time.time() // 60 * 60
+
+    level = predict(h, [now])[0, k]
+    trend = predict(h, [now], 1)[0, k]
+    high_time, high, low_time, low = (i[k] for i in next_extremes(h, now))
+    if np.isnan(high_time) or np.isnan(low_time):
+        return dic
+
+    local = lambda t: datetime.fromtimestamp(60 * round(t / 60), TIMEZONE).strftime('%a %d %H:%M')
+
+    high, low = '%.1f' % high, '%.1f' % low
+    high_time, low_time = local(high_time), local(low_time)
+    if trend > 0:
+        extremes = dict(STATUS='flood', tide1extreme='HIGH', tide2extreme='LOW',
+            tide1extremeValue=high, tide1extremeTime=high_time, 
+            tide2extremeValue=low, tide2extremeTime=low_time)
+    else:
+        extremes = dict(STATUS='ebb', tide1extreme='LOW', tide2extreme='HIGH',
+            tide1extremeValue=low, tide1extremeTime=low_time, 
+            tide2extremeValue=high, tide2extremeTime=high_time)
+
+    # Sites that dry out show "LOW TIDE" instead of the sea level
+    if dic.get('tidewet') != 'LOW TIDE':
+        dic = {**dic, 'tidewet': '%.1f' % level}
+
+    return {**dic, **extremes, 'time': local(now)}
+
 @app.route('/', methods=['GET', 'POST'])
 def galway():
 
@@ -57,14 +231,82 @@ def galway():
 ''' Galway Bay Dashboard '''
 @app.route('/Galway-Bay/<site>/')
 def dashboard(site):
-    data = dataload(f'/data/pkl/Galway-Bay/{site}.pkl', {})
+    data = snapshot(site, {})
     data = dataload(f'/data/BIRDS/{site}-WEB.pkl', data)
     return render_template('galway-dashboard.html', **data)
 
+''' Galway Bay tide table '''
+@app.route('/Galway-Bay/<site>/tides')
+def tides(site):
+    ''' High and low tides at a site for the given number of days (default 1) 
+        from the given date (YYYY-MM-DD, default today), as JSON '''
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d') \
+            if 'date' in request.args else datetime.now(TIMEZONE).replace(tzinfo=None)
+    except ValueError:
+        abort(400)
+    # Up to two weeks, e.g. to print a tide table
+    days = min(max(request.args.get('days', default=1, type=int), 1), 14)
+
+    # Local midnight to local midnight, across any change of summer time
+    day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = TIMEZONE.localize(day).timestamp()
+    end = TIMEZONE.localize(day + timedelta(days=days)).timestamp()
+
+    found = find_snapshot(site)
+    if found is None:
+        return jsonify(site=site, tides=[])
+    etag, modified, max_age = validators(site, found[1])
+
+    return conditional(lambda: dict(site=site, tides=tide_table(site, start, end)),
+                       etag, modified, max_age)
+
+''' JSON API '''
+@app.route('/api/v1/<site>/forecast')
+def api_forecast(site):
+    ''' Display fields of a site (as in the dashboard) as JSON, with the 
+        status of the site in the latest snapshot '''
+    found = find_snapshot(site)
+    if found is None:
+        abort(404)
+    header = found[1]
+    etag, modified, max_age = validators(site, header)
+
+    return conditional(lambda: dict(site=site, model=header['model'], 
+        version=header['version'], status=header.get('status', {}).get(site, {}),
+        forecast=snapshot(site, {})), etag, modified, max_age)
+
+@app.route('/api/v1/<site>/birds')
+def api_birds(site):
+    ''' Bird observations at a site, grouped by map marker, as JSON '''
+    filename = site.replace("'", "_").replace(" ", "-") 
+    path = f'/data/BIRDS/{filename}-WEB.pkl'
+    try:
+        # The validators are those of the cached file served, which may be
+        # a few seconds older than the file on disk
+        data, mtime, size = FILES.entry(path, load_birds)
+    except FileNotFoundError:
+        abort(404)
+
+    def payload():
+        return dict(site=site, title=data.get('title'), markers=[
+            dict(latitude=float(marker['lat']), longitude=float(marker['lon']), 
+                 sightings=[dict(i, url=picture_url(i['pic'])) for i in marker['sightings']])
+            for marker in data['markers'].values()])
+
+    return conditional(payload, f'birds-{mtime}-{size}', mtime / 1e9, BIRDS_MAX_AGE)
+
+''' Cache statistics of this worker '''
+@app.route('/cache')
+def cache():
+    return jsonify(FILES.stats())
+
 ''' Galway Bay eBird '''
 @app.route('/eBird')
 def form():
-    ''' Process bird requests from Leaflet map '''
+    ''' Process bird requests from Leaflet map. The sightings at the clicked
+        marker are found by the marker key. Add "format=json" to get them as
+        JSON '''
 
     # Get longitude of request 
     longitude = request.args.get('longitude', type=float)
@@ -72,54 +314,37 @@ def form():
     latitude = request.args.get('latitude', type=float)
     # Get corresponding site name (Renville, Kinvara, etc.)
     site = request.args.get('site')
+    if longitude is None or latitude is None or site is None:
+        abort(400)
     # Get formatted site name for archive file name
     # as generated by the back-end bird container.
     filename = site.replace("'", "_").replace(" ", "-") 
 
     root = '/data/BIRDS/'
-    with open(f'{root}{filename}-WEB.pkl', 'rb') as f:
-        data = load(f) # Load eBird observations
-
-    # Get coordinates of sightings
-    lon, lat = data.get('lonBird'), data.get('latBird')
-    # Convert strings to numbers
-    lon = [float(i) for i in lon]
-    lat = [float(i) for i in lat]
-    # Get times and sites of observations
-    t, loc = data.get('t'), data.get('loc')
-    # Get species names, both common and scientific
-    cm, sc = data.get('cm'), data.get('sc')
-    # Get image files and paths
-    pic = data.get('pic')
+    try: # Load eBird observations
+        data = FILES.get(f'{root}{filename}-WEB.pkl', load_birds)
+    except FileNotFoundError:
+        abort(404)
+
+    # Sightings at the clicked marker
+    marker = data['markers'].get(marker_key(longitude, latitude), {})
+    sightings = marker.get('sightings', [])
     # Get title
     title = data.get('title')
 
-    where, common, species, picture, when = [], [], [], [], []
-    # Keep only those observations matching the clicked marker
-    for i, j, T, Com, Sci, Pic, Loc in zip(lon, lat, t, cm, sc, pic, loc):
-        if ( abs(i - longitude) < 1e-8 ) and (abs(j - latitude) < 1e-8):
-            where.append(Loc)
-            common.append(Com)
-            species.append(Sci)
-            picture.append(Pic)
-            when.append(T)
-
-    # Move bird pictures to static folder
-    imdir = '/app/app/static/BIRDS/'
-    if not os.path.isdir(imdir):
-        os.makedirs(imdir)
-
-    for pic in picture:
-        name = os.path.basename(pic)
-        if not os.path.isfile(f'{imdir}{name}'):
-            shutil.copy2(pic, imdir)
-
-    im = []
-    for pic in picture:
-        folder = os.path.dirname(pic)
-        im.append(pic.replace(folder, '../static/BIRDS'))
+    # URLs of the bird pictures
+    urls = [picture_url(i['pic']) for i in sightings]
+
+    if request.args.get('format') == 'json':
+        return jsonify(site=site, title=title, longitude=longitude, latitude=latitude,
+                       sightings=[dict(i, url=url) for i, url in zip(sightings, urls)])
+
+    where = [i['loc'] for i in sightings]
+    common = [i['cm'] for i in sightings]
+    species = [i['sc'] for i in sightings]
+    when = [i['t'] for i in sightings]
 
     return render_template("form.html", 
             longitude=longitude, latitude=latitude,
             site=site, title=title,
-            entries=zip(where, common, species, im, when))
+            entries=zip(where, common, species, urls, when))
@@ -0,0 +1,9 @@
+#! /usr/bin/env bash
+# Run by the container before starting the app. The bird pictures are
+# published by the eBird container to the shared volume (/data/BIRDS/www).
+# Link them from the static folder, so that nginx serves them directly
+mkdir -p /data/BIRDS/www
+if [ -d /app/app/static/BIRDS ] && [ ! -L /app/app/static/BIRDS ]; then
+    rm -rf /app/app/static/BIRDS # Pictures copied by earlier versions
+fi
+ln -sfn /data/BIRDS/www /app/app/static/BIRDS
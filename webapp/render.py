@@ -0,0 +1,6 @@
+from app.render import loop
+
+# Render the site dashboards to static files as the data change. Started
+# by uWSGI next to the app (see uwsgi.ini)
+if __name__ == '__main__':
+    loop()